@@ -9,6 +9,62 @@ import { fetcher } from "../../utils/fetcher";
 import { tryCatch } from "../../utils/try-catch";
 import type { garminKeys } from "./constants";
 
+// Single-date /sleep payload.
+const sleepSchema = z.object({
+	date: z.string().transform((v) => dayjs(v)),
+	// Garmin hasn't finished scoring very recent nights yet, so
+	// these come back null rather than being omitted.
+	sleep_score: z.number().nullable(),
+	quality: z.enum(["EXCELLENT", "GOOD", "FAIR", "POOR"]).nullable(),
+	light_pct_score: z.number().nullable(),
+	light_pct_quality: z
+		.enum(["EXCELLENT", "GOOD", "FAIR", "POOR"])
+		.nullable(),
+	deep_pct_score: z.number().nullable(),
+	deep_pct_quality: z
+		.enum(["EXCELLENT", "GOOD", "FAIR", "POOR"])
+		.nullable(),
+	rem_pct_score: z.number().nullable(),
+	rem_pct_quality: z
+		.enum(["EXCELLENT", "GOOD", "FAIR", "POOR"])
+		.nullable(),
+	// Garmin also omits the durations themselves (not just the
+	// scores) for nights it hasn't finished processing yet.
+	total_seconds: z.number().nullable(),
+	total_hours: z.number().nullable(),
+	deep_seconds: z.number().nullable(),
+	deep_hours: z.number().nullable(),
+	light_seconds: z.number().nullable(),
+	light_hours: z.number().nullable(),
+	rem_seconds: z.number().nullable(),
+	rem_hours: z.number().nullable(),
+	awake_seconds: z.number().nullable(),
+	awake_hours: z.number().nullable(),
+	awake_count: z.number().nullable(),
+});
+
+// Single-date /hr payload.
+const hrSchema = z.object({
+	date: z.string().transform((v) => dayjs(v)),
+	// Garmin returns these as null for dates without a finished
+	// HR summary yet (e.g. very recent dates).
+	resting_hr: z.number().nullable(),
+	max_hr: z.number().nullable(),
+	min_hr: z.number().nullable(),
+	avg_hr: z.number().nullish(),
+	timeseries: z.array(
+		z.object({
+			time: z.string().transform((v) => dayjs(v)),
+			bpm: z.number().nullable().catch(null),
+		}),
+	),
+});
+
+// A day whose upstream call failed, in place of its payload.
+const dayErrorSchema = z.object({
+	error: z.string(),
+});
+
 export class GarminClient {
 	private readonly baseUrl: string = "http://localhost:3011";
 	private readonly garminAdminKey: string;
@@ -26,7 +82,7 @@ export class GarminClient {
 		}
 	}
 
-	async authenticate(email: string, password: string) {
+	async authenticate(email: string, password: string, account: string) {
 		const { data } = await fetcher(
 			`${this.baseUrl}/update-credentials`,
 			z.object({
@@ -37,6 +93,7 @@ export class GarminClient {
 				headers: {
 					"Content-Type": "application/json",
 					"X-API-Key": this.garminAdminKey,
+					"X-Garmin-Account": account,
 				},
 				body: JSON.stringify({ email, password }),
 			},
@@ -45,6 +102,22 @@ export class GarminClient {
 		return data?.status === "success" ? ok() : err();
 	}
 
+	async isAuthenticated(account: string) {
+		const { data } = await fetcher(
+			`${this.baseUrl}/health`,
+			z.object({
+				authenticated: z.boolean(),
+			}),
+			{
+				headers: {
+					"X-Garmin-Account": account,
+				},
+			},
+		);
+
+		return data?.authenticated === true;
+	}
+
 	async refreshAccessToken(refreshToken: string) {
 		const searchParams = new URLSearchParams();
 
@@ -120,15 +193,24 @@ export class GarminClient {
 			return err("No email/password");
 		}
 
-		this.authenticate(
-			decrypt(integration.garminEmail),
-			decrypt(integration.garminPassword),
-		);
+		// The garmin microservice keeps a session per account (keyed by
+		// integration), so only log in when it doesn't already have one.
+		const headers = { "X-Garmin-Account": integration.id };
+
+		if (!(await this.isAuthenticated(integration.id))) {
+			const auth = await this.authenticate(
+				decrypt(integration.garminEmail),
+				decrypt(integration.garminPassword),
+				integration.id,
+			);
 
-		const headers = {};
+			if (auth.isErr()) {
+				return err("Failed to authenticate with Garmin");
+			}
+		}
 
 		const today = dayjs();
-		const dates: string[] = [];
+		let dates: string[] = [];
 
 		let current = dayjs(from);
 		while (current.isBefore(today) || current.isSame(today, "day")) {
@@ -136,6 +218,31 @@ export class GarminClient {
 			current = current.add(1, "day");
 		}
 
+		// Ask the microservice which of these days it hasn't handed us in final
+		// form yet, so a daily sync only re-imports the last day or two. If it
+		// can't tell us, import the whole range as before.
+		const { data: sync, error: syncError } = await fetcher(
+			`${this.baseUrl}/sync?start=${dates[0]}&end=${dates[dates.length - 1]}&metrics=sleep,hr,hrv`,
+			z.object({
+				cursor: z.string().nullable(),
+				days: z.record(z.string(), z.record(z.string(), z.string())),
+			}),
+			{ headers },
+		);
+
+		if (syncError) {
+			console.error("Failed to fetch Garmin sync state", syncError);
+		} else {
+			dates = dates.filter((date) => date in sync.days);
+
+			if (dates.length === 0) {
+				return ok(0);
+			}
+		}
+
+		// Only mark the days as synced if every one of them imported cleanly.
+		let failed = false;
+
 		console.log(
 			"Importing Garmin data for the following dates:",
 			dates.join(", "),
@@ -152,250 +259,245 @@ export class GarminClient {
 			integrationId: string;
 		}> = [];
 
-		// Fetch sleep data for each date
+		// One /bundle call fetches sleep and HR for a whole run of days, so the
+		// import costs a round trip per run rather than two per day. Runs only
+		// span consecutive dates, so days /sync skipped aren't fetched again.
+		const BUNDLE_CHUNK_SIZE = 31;
+		const runs: string[][] = [];
+
 		for (const date of dates) {
+			const run = runs[runs.length - 1];
+			const previous = run?.[run.length - 1];
+
+			if (
+				run &&
+				run.length < BUNDLE_CHUNK_SIZE &&
+				dayjs(previous).add(1, "day").format("YYYY-MM-DD") === date
+			) {
+				run.push(date);
+			} else {
+				runs.push([date]);
+			}
+		}
+
+		for (const run of runs) {
 			try {
-				const { data: sleepData, error: sleepError } = await fetcher(
-					`${this.baseUrl}/sleep?date=${date}`,
-					z.object({
-						date: z.string().transform((v) => dayjs(v)),
-						// Garmin hasn't finished scoring very recent nights yet, so
-						// these come back null rather than being omitted.
-						sleep_score: z.number().nullable(),
-						quality: z.enum(["EXCELLENT", "GOOD", "FAIR", "POOR"]).nullable(),
-						light_pct_score: z.number().nullable(),
-						light_pct_quality: z
-							.enum(["EXCELLENT", "GOOD", "FAIR", "POOR"])
-							.nullable(),
-						deep_pct_score: z.number().nullable(),
-						deep_pct_quality: z
-							.enum(["EXCELLENT", "GOOD", "FAIR", "POOR"])
-							.nullable(),
-						rem_pct_score: z.number().nullable(),
-						rem_pct_quality: z
-							.enum(["EXCELLENT", "GOOD", "FAIR", "POOR"])
-							.nullable(),
-						// Garmin also omits the durations themselves (not just the
-						// scores) for nights it hasn't finished processing yet.
-						total_seconds: z.number().nullable(),
-						total_hours: z.number().nullable(),
-						deep_seconds: z.number().nullable(),
-						deep_hours: z.number().nullable(),
-						light_seconds: z.number().nullable(),
-						light_hours: z.number().nullable(),
-						rem_seconds: z.number().nullable(),
-						rem_hours: z.number().nullable(),
-						awake_seconds: z.number().nullable(),
-						awake_hours: z.number().nullable(),
-						awake_count: z.number().nullable(),
-					}),
-					{
-						headers,
-					},
+				const { data: bundle, error: bundleError } = await fetcher(
+					`${this.baseUrl}/bundle?start=${run[0]}&end=${run[run.length - 1]}&metrics=sleep,hr`,
+					z.record(
+						z.string(),
+						z.object({
+							sleep: z.union([sleepSchema, dayErrorSchema]),
+							hr: z.union([hrSchema, dayErrorSchema]),
+						}),
+					),
+					{ headers },
 				);
 
-				if (sleepError) {
-					console.error("Failed to fetch sleep data for", date, sleepError);
+				if (bundleError) {
+					failed = true;
+					console.error(
+						"Failed to fetch sleep and HR data for",
+						run[0],
+						"-",
+						run[run.length - 1],
+						bundleError,
+					);
 					continue;
 				}
 
-				if (sleepData) {
-					console.log(
-						"Received sleep data for",
-						sleepData.date.format("YYYY-MM-DD"),
-					);
-
-					if (sleepData.sleep_score !== null) {
-						observations.push({
-							source: "garmin",
-							type: "sleep_score",
-							label: "Sleep Score",
-							unit: "score",
-							value: sleepData.sleep_score,
-							observedAt: sleepData.date.toDate(),
-							userId: integration.userId,
-							integrationId: integration.id,
-						});
-					}
-
-					if (sleepData.total_hours !== null) {
-						observations.push({
-							source: "garmin",
-							type: "sleep_total_hours",
-							label: "Total Sleep Hours",
-							unit: "hours",
-							value: sleepData.total_hours,
-							observedAt: sleepData.date.toDate(),
-							userId: integration.userId,
-							integrationId: integration.id,
-						});
-					}
-
-					if (sleepData.deep_hours !== null) {
-						observations.push({
-							source: "garmin",
-							type: "sleep_deep_hours",
-							label: "Deep Sleep Hours",
-							unit: "hours",
-							value: sleepData.deep_hours,
-							observedAt: sleepData.date.toDate(),
-							userId: integration.userId,
-							integrationId: integration.id,
-						});
-					}
-
-					if (sleepData.light_hours !== null) {
-						observations.push({
-							source: "garmin",
-							type: "sleep_light_hours",
-							label: "Light Sleep Hours",
-							unit: "hours",
-							value: sleepData.light_hours,
-							observedAt: sleepData.date.toDate(),
-							userId: integration.userId,
-							integrationId: integration.id,
-						});
-					}
-
-					if (sleepData.rem_hours !== null) {
-						observations.push({
-							source: "garmin",
-							type: "sleep_rem_hours",
-							label: "REM Sleep Hours",
-							unit: "hours",
-							value: sleepData.rem_hours,
-							observedAt: sleepData.date.toDate(),
-							userId: integration.userId,
-							integrationId: integration.id,
-						});
-					}
+				for (const [date, { sleep: sleepData, hr: hrData }] of Object.entries(
+					bundle,
+				)) {
+					if ("error" in sleepData) {
+						failed = true;
+						console.error(
+							"Failed to fetch sleep data for",
+							date,
+							sleepData.error,
+						);
+					} else {
+						console.log(
+							"Received sleep data for",
+							sleepData.date.format("YYYY-MM-DD"),
+						);
+
+						if (sleepData.sleep_score !== null) {
+							observations.push({
+								source: "garmin",
+								type: "sleep_score",
+								label: "Sleep Score",
+								unit: "score",
+								value: sleepData.sleep_score,
+								observedAt: sleepData.date.toDate(),
+								userId: integration.userId,
+								integrationId: integration.id,
+							});
+						}
 
-					if (sleepData.awake_hours !== null) {
-						observations.push({
-							source: "garmin",
-							type: "sleep_awake_hours",
-							label: "Awake Hours",
-							unit: "hours",
-							value: sleepData.awake_hours,
-							observedAt: sleepData.date.toDate(),
-							userId: integration.userId,
-							integrationId: integration.id,
-						});
-					}
-				}
-			} catch (e) {
-				console.error("Failed to fetch sleep data:", e);
-			}
+						if (sleepData.total_hours !== null) {
+							observations.push({
+								source: "garmin",
+								type: "sleep_total_hours",
+								label: "Total Sleep Hours",
+								unit: "hours",
+								value: sleepData.total_hours,
+								observedAt: sleepData.date.toDate(),
+								userId: integration.userId,
+								integrationId: integration.id,
+							});
+						}
 
-			// Fetch HR data for each date
-			try {
-				const { data: hrData, error: hrError } = await fetcher(
-					`${this.baseUrl}/hr?date=${date}`,
-					z.object({
-						date: z.string().transform((v) => dayjs(v)),
-						// Garmin returns these as null for dates without a finished
-						// HR summary yet (e.g. very recent dates).
-						resting_hr: z.number().nullable(),
-						max_hr: z.number().nullable(),
-						min_hr: z.number().nullable(),
-						avg_hr: z.number().nullish(),
-						timeseries: z.array(
-							z.object({
-								time: z.string().transform((v) => dayjs(v)),
-								bpm: z.number().nullable().catch(null),
-							}),
-						),
-					}),
-					{
-						headers,
-					},
-				);
+						if (sleepData.deep_hours !== null) {
+							observations.push({
+								source: "garmin",
+								type: "sleep_deep_hours",
+								label: "Deep Sleep Hours",
+								unit: "hours",
+								value: sleepData.deep_hours,
+								observedAt: sleepData.date.toDate(),
+								userId: integration.userId,
+								integrationId: integration.id,
+							});
+						}
 
-				if (hrError) {
-					console.error("Failed to fetch HR data for", date, hrError);
-					continue;
-				}
+						if (sleepData.light_hours !== null) {
+							observations.push({
+								source: "garmin",
+								type: "sleep_light_hours",
+								label: "Light Sleep Hours",
+								unit: "hours",
+								value: sleepData.light_hours,
+								observedAt: sleepData.date.toDate(),
+								userId: integration.userId,
+								integrationId: integration.id,
+							});
+						}
 
-				if (hrData) {
-					console.log("Received HR data for", hrData.date.format("YYYY-MM-DD"));
+						if (sleepData.rem_hours !== null) {
+							observations.push({
+								source: "garmin",
+								type: "sleep_rem_hours",
+								label: "REM Sleep Hours",
+								unit: "hours",
+								value: sleepData.rem_hours,
+								observedAt: sleepData.date.toDate(),
+								userId: integration.userId,
+								integrationId: integration.id,
+							});
+						}
 
-					if (hrData.resting_hr !== null) {
-						observations.push({
-							source: "garmin",
-							type: "resting_heart_rate",
-							label: "Resting Heart Rate",
-							unit: "bpm",
-							value: hrData.resting_hr,
-							observedAt: hrData.date.toDate(),
-							userId: integration.userId,
-							integrationId: integration.id,
-						});
-					}
-					if (hrData.max_hr !== null) {
-						observations.push({
-							source: "garmin",
-							type: "heart_rate_max",
-							label: "Max Heart Rate",
-							unit: "bpm",
-							value: hrData.max_hr,
-							observedAt: hrData.date.toDate(),
-							userId: integration.userId,
-							integrationId: integration.id,
-						});
-					}
-					if (hrData.min_hr !== null) {
-						observations.push({
-							source: "garmin",
-							type: "heart_rate_min",
-							label: "Min Heart Rate",
-							unit: "bpm",
-							value: hrData.min_hr,
-							observedAt: hrData.date.toDate(),
-							userId: integration.userId,
-							integrationId: integration.id,
-						});
+						if (sleepData.awake_hours !== null) {
+							observations.push({
+								source: "garmin",
+								type: "sleep_awake_hours",
+								label: "Awake Hours",
+								unit: "hours",
+								value: sleepData.awake_hours,
+								observedAt: sleepData.date.toDate(),
+								userId: integration.userId,
+								integrationId: integration.id,
+							});
+						}
 					}
 
-					if (hrData.avg_hr !== null && hrData.avg_hr !== undefined) {
-						observations.push({
-							source: "garmin",
-							type: "heart_rate_avg",
-							label: "Average Heart Rate",
-							unit: "bpm",
-							value: hrData.avg_hr,
-							observedAt: hrData.date.toDate(),
-							userId: integration.userId,
-							integrationId: integration.id,
-						});
-					}
+					if ("error" in hrData) {
+						failed = true;
+						console.error(
+							"Failed to fetch HR data for",
+							date,
+							hrData.error,
+						);
+					} else {
+						console.log(
+							"Received HR data for",
+							hrData.date.format("YYYY-MM-DD"),
+						);
+
+						if (hrData.resting_hr !== null) {
+							observations.push({
+								source: "garmin",
+								type: "resting_heart_rate",
+								label: "Resting Heart Rate",
+								unit: "bpm",
+								value: hrData.resting_hr,
+								observedAt: hrData.date.toDate(),
+								userId: integration.userId,
+								integrationId: integration.id,
+							});
+						}
+						if (hrData.max_hr !== null) {
+							observations.push({
+								source: "garmin",
+								type: "heart_rate_max",
+								label: "Max Heart Rate",
+								unit: "bpm",
+								value: hrData.max_hr,
+								observedAt: hrData.date.toDate(),
+								userId: integration.userId,
+								integrationId: integration.id,
+							});
+						}
+						if (hrData.min_hr !== null) {
+							observations.push({
+								source: "garmin",
+								type: "heart_rate_min",
+								label: "Min Heart Rate",
+								unit: "bpm",
+								value: hrData.min_hr,
+								observedAt: hrData.date.toDate(),
+								userId: integration.userId,
+								integrationId: integration.id,
+							});
+						}
 
-					for (const reading of hrData.timeseries) {
-						// Skip readings with null bpm values to avoid NOT NULL constraint violation
-						if (reading.bpm !== null && reading.bpm !== undefined) {
+						if (hrData.avg_hr !== null && hrData.avg_hr !== undefined) {
 							observations.push({
 								source: "garmin",
-								type: "heart_rate",
-								label: "Heart Rate",
+								type: "heart_rate_avg",
+								label: "Average Heart Rate",
 								unit: "bpm",
-								value: reading.bpm,
-								observedAt: dayjs(reading.time).toDate(),
+								value: hrData.avg_hr,
+								observedAt: hrData.date.toDate(),
 								userId: integration.userId,
 								integrationId: integration.id,
 							});
 						}
+
+						for (const reading of hrData.timeseries) {
+							// Skip readings with null bpm values to avoid NOT NULL constraint violation
+							if (reading.bpm !== null && reading.bpm !== undefined) {
+								observations.push({
+									source: "garmin",
+									type: "heart_rate",
+									label: "Heart Rate",
+									unit: "bpm",
+									value: reading.bpm,
+									observedAt: dayjs(reading.time).toDate(),
+									userId: integration.userId,
+									integrationId: integration.id,
+								});
+							}
+						}
 					}
 				}
 			} catch (e) {
-				console.error("Failed to fetch HR data:", e);
+				failed = true;
+				console.error(
+					"Failed to fetch sleep and HR data for",
+					run[0],
+					"-",
+					run[run.length - 1],
+					":",
+					e,
+				);
 			}
 		}
 
-		// Chunked to keep each request to the (single-threaded) garmin
-		// microservice small - requesting the full range in one call makes it
-		// do hundreds of sequential upstream Garmin calls inside one HTTP
-		// request, which blocks the server long enough for the connection
-		// to drop before it can respond.
-		const HRV_CHUNK_SIZE = 14;
+		// The garmin microservice fetches the days of a range in parallel, but
+		// chunking still keeps a long backfill from holding one connection
+		// open for hundreds of upstream calls.
+		const HRV_CHUNK_SIZE = 31;
 
 		for (let i = 0; i < dates.length; i += HRV_CHUNK_SIZE) {
 			const chunk = dates.slice(i, i + HRV_CHUNK_SIZE);
@@ -404,29 +506,38 @@ export class GarminClient {
 				const { data: hrvData, error: hrvError } = await fetcher(
 					`${this.baseUrl}/hrv?start=${chunk[0]}&end=${chunk[chunk.length - 1]}`,
 					z.array(
-						z.object({
-							date: z.string().transform((v) => dayjs(v)),
-							// Garmin's HRV baseline isn't established for every day
-							// (e.g. very recent dates, or accounts without enough
-							// history yet), so these come back null individually.
-							lastNightAvg: z.number().nullable(),
-							lowUpper: z.number().nullable(),
-							balancedLow: z.number().nullable(),
-							balancedUpper: z.number().nullable(),
-							markerValue: z.number().nullable(),
-							readings: z.array(
-								z.object({
-									hrvValue: z.number(),
-									readingTimeGMT: z.string().transform((v) => dayjs(v)),
-									readingTimeLocal: z.string().transform((v) => dayjs(v)),
-								}),
-							),
-						}),
+						z.union([
+							z.object({
+								date: z.string().transform((v) => dayjs(v)),
+								// Garmin's HRV baseline isn't established for every day
+								// (e.g. very recent dates, or accounts without enough
+								// history yet), so these come back null individually.
+								lastNightAvg: z.number().nullable(),
+								lowUpper: z.number().nullable(),
+								balancedLow: z.number().nullable(),
+								balancedUpper: z.number().nullable(),
+								markerValue: z.number().nullable(),
+								readings: z.array(
+									z.object({
+										hrvValue: z.number(),
+										readingTimeGMT: z.string().transform((v) => dayjs(v)),
+										readingTimeLocal: z.string().transform((v) => dayjs(v)),
+									}),
+								),
+							}),
+							// Days whose upstream call failed come back in place
+							// with just the date and an error.
+							z.object({
+								date: z.string(),
+								error: z.string(),
+							}),
+						]),
 					),
 					{ headers },
 				);
 
 				if (hrvError) {
+					failed = true;
 					console.error(
 						"Failed to fetch HRV data for",
 						chunk[0],
@@ -438,6 +549,16 @@ export class GarminClient {
 				}
 
 				for (const reading of hrvData || []) {
+					if ("error" in reading) {
+						failed = true;
+						console.error(
+							"Failed to fetch HRV data for",
+							reading.date,
+							reading.error,
+						);
+						continue;
+					}
+
 					console.log("Received HRV data for", reading.date.format("YYYY-MM-DD"));
 
 					if (reading.lastNightAvg !== null) {
@@ -506,6 +627,7 @@ export class GarminClient {
 					}
 				}
 			} catch (e) {
+				failed = true;
 				console.error(
 					"Failed to fetch HRV data for",
 					chunk[0],
@@ -543,6 +665,22 @@ export class GarminClient {
 			imported += result.length;
 		}
 
+		if (!failed && sync?.cursor) {
+			const { error: commitError } = await fetcher(
+				`${this.baseUrl}/sync/commit`,
+				z.object({ status: z.literal("success") }),
+				{
+					method: "POST",
+					headers: { ...headers, "Content-Type": "application/json" },
+					body: JSON.stringify({ cursor: sync.cursor }),
+				},
+			);
+
+			if (commitError) {
+				console.error("Failed to commit Garmin sync state", commitError);
+			}
+		}
+
 		return ok(imported);
 	}
 }
@@ -0,0 +1,320 @@
+"""
+Fake Garmin Connect client for benchmarks and offline runs.
+
+FakeGarmin stands in for garminconnect.Garmin behind the service's session
+pool, so every endpoint runs its real code path without touching the
+network. Each call sleeps for a configurable latency and can fail the way
+Garmin does: 429 throttling with Retry-After, 5xx errors and dropped
+connections, all raised as the requests exceptions garth would wrap.
+
+Payloads are shaped like the real ones and deterministic per date:
+intraday HR at 2-minute resolution with gaps, overnight HRV readings every
+5 minutes, and sleep DTOs whose scores are missing for recent nights (and a
+few older ones) just as when Garmin hasn't finished processing a night.
+
+Usage:
+    import main
+    from bench.fake_garmin import FakeGarmin
+
+    main.sessions.set(main.DEFAULT_ACCOUNT, FakeGarmin(latency=0.2, throttle_rate=0.02))
+"""
+
+import random
+import threading
+import time
+from datetime import date, datetime, timedelta, timezone
+
+import requests
+
+DAY_MS = 86_400_000
+
+
+def day_start_ms(day: str) -> int:
+    """Epoch ms of local midnight, treating local time as UTC."""
+    d = date.fromisoformat(day)
+    return int(datetime(d.year, d.month, d.day, tzinfo=timezone.utc).timestamp() * 1000)
+
+
+def http_error(status: int, retry_after: float | None = None) -> requests.HTTPError:
+    """An HTTPError carrying a response, like the ones garth raises."""
+    response = requests.Response()
+    response.status_code = status
+    if retry_after is not None:
+        response.headers["Retry-After"] = str(int(retry_after))
+    return requests.HTTPError(f"{status} Error: fake Garmin Connect", response=response)
+
+
+class FakeGarmin:
+    """Drop-in for garminconnect.Garmin serving synthetic data.
+
+    latency is the mean seconds per call, jitter the +/- fraction around
+    it. throttle_rate, error_rate and disconnect_rate are the chances of a
+    call failing with a 429, a 5xx or a dropped connection. recent_unscored
+    is how many of the latest nights come back without sleep scores.
+    """
+
+    def __init__(self, latency: float = 0.2, jitter: float = 0.25, throttle_rate: float = 0.0,
+                 error_rate: float = 0.0, disconnect_rate: float = 0.0, retry_after: float = 1,
+                 recent_unscored: int = 1, activities: int = 500, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.disconnect_rate = disconnect_rate
+        self.retry_after = retry_after
+        self.recent_unscored = recent_unscored
+        self.activities = activities
+        self.seed = seed
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls: dict[str, int] = {}
+
+    def _call(self, name: str):
+        """Count, wait and maybe fail one upstream call."""
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            roll = self._random.random()
+            spread = self._random.uniform(-self.jitter, self.jitter)
+
+        time.sleep(max(0.0, self.latency * (1 + spread)))
+
+        if roll < self.throttle_rate:
+            raise http_error(429, self.retry_after)
+        roll -= self.throttle_rate
+        if roll < self.error_rate:
+            raise http_error(503)
+        roll -= self.error_rate
+        if roll < self.disconnect_rate:
+            raise requests.ConnectionError("Connection aborted: fake Garmin Connect")
+
+    def _rng(self, *key) -> random.Random:
+        """A generator seeded by the call's arguments, so payloads repeat."""
+        return random.Random("/".join(map(str, (self.seed, *key))))
+
+    # Profile
+
+    def get_full_name(self):
+        self._call("get_full_name")
+        return "Bench Athlete"
+
+    def get_user_profile(self):
+        self._call("get_user_profile")
+        return {"id": 12345678, "userName": "bench", "displayName": "bench", "fullName": "Bench Athlete"}
+
+    # Daily metrics
+
+    def get_sleep_data(self, day: str):
+        self._call("get_sleep_data")
+        rng = self._rng("sleep", day)
+        age = (datetime.now(timezone.utc).date() - date.fromisoformat(day)).days
+        start = day_start_ms(day) - 2 * 3_600_000 + rng.randint(0, 90) * 60_000
+        deep, light, rem, awake = (rng.randint(a, b) * 60 for a, b in ((40, 110), (180, 280), (60, 130), (5, 45)))
+
+        dto = {
+            "calendarDate": day,
+            "sleepStartTimestampGMT": start,
+            "sleepEndTimestampGMT": start + (deep + light + rem + awake) * 1000,
+            "sleepTimeSeconds": deep + light + rem,
+            "deepSleepSeconds": deep,
+            "lightSleepSeconds": light,
+            "remSleepSeconds": rem,
+            "awakeSleepSeconds": awake,
+            "awakeCount": rng.randint(0, 4),
+        }
+        # Recent nights (and the odd older one) aren't scored yet.
+        if age >= self.recent_unscored and rng.random() > 0.03:
+            dto["sleepScores"] = {
+                "overall": {"value": rng.randint(45, 95), "qualifierKey": rng.choice(["EXCELLENT", "GOOD", "FAIR", "POOR"])},
+                "lightPercentage": {"value": rng.randint(40, 65), "qualifierKey": "GOOD"},
+                "deepPercentage": {"value": rng.randint(10, 25), "qualifierKey": "GOOD"},
+                "remPercentage": {"value": rng.randint(15, 28), "qualifierKey": "FAIR"},
+            }
+        return {
+            "dailySleepDTO": dto,
+            "sleepMovement": [
+                {"startGMT": start + i * 60_000, "activityLevel": round(rng.random(), 3)}
+                for i in range(0, (deep + light + rem + awake) // 60)
+            ],
+        }
+
+    def get_heart_rates(self, day: str):
+        self._call("get_heart_rates")
+        rng = self._rng("hr", day)
+        start = day_start_ms(day)
+        resting = rng.randint(44, 58)
+        values = []
+        for i in range(720):
+            # Off-wrist gaps come back as nulls.
+            bpm = None if rng.random() < 0.04 else resting + int(abs(rng.gauss(20, 15)))
+            values.append([start + i * 120_000, bpm])
+        recorded = [v for _, v in values if v is not None]
+        return {
+            "calendarDate": day,
+            "startTimestampGMT": start,
+            "endTimestampGMT": start + DAY_MS,
+            "restingHeartRate": resting,
+            "maxHeartRate": max(recorded),
+            "minHeartRate": min(recorded),
+            "lastSevenDaysAvgRestingHeartRate": resting + rng.randint(-2, 2),
+            "heartRateValueDescriptors": [{"key": "timestamp", "index": 0}, {"key": "heartrate", "index": 1}],
+            "heartRateValues": values,
+        }
+
+    def get_hrv_data(self, day: str):
+        self._call("get_hrv_data")
+        rng = self._rng("hrv", day)
+        age = (datetime.now(timezone.utc).date() - date.fromisoformat(day)).days
+        if age < 0 or rng.random() < 0.02:
+            return None
+        start = day_start_ms(day) - 3_600_000
+        avg = rng.randint(35, 75)
+        summary = {"calendarDate": day, "weeklyAvg": avg + rng.randint(-5, 5), "lastNightAvg": avg,
+                   "lastNight5MinHigh": avg + rng.randint(10, 30), "status": "BALANCED"}
+        if age >= self.recent_unscored:
+            summary["baseline"] = {"lowUpper": 38, "balancedLow": 42, "balancedUpper": 62,
+                                   "markerValue": round(rng.random(), 2)}
+        return {
+            "hrvSummary": summary,
+            "hrvReadings": [
+                {"hrvValue": max(10, int(rng.gauss(avg, 12))), "readingTimeGMT": start + i * 300_000}
+                for i in range(96)
+            ],
+        }
+
+    def get_rhr_day(self, day: str):
+        self._call("get_rhr_day")
+        rng = self._rng("hr", day)
+        return {"allMetrics": {"metricsMap": {"WELLNESS_RESTING_HEART_RATE": [
+            {"value": float(rng.randint(44, 58)), "calendarDate": day}
+        ]}}}
+
+    def get_all_day_stress(self, day: str):
+        self._call("get_all_day_stress")
+        rng = self._rng("stress", day)
+        start = day_start_ms(day)
+        stress = [[start + i * 180_000, rng.choice([-1, -2]) if rng.random() < 0.08 else rng.randint(5, 80)]
+                  for i in range(480)]
+        battery = [[start + i * 180_000, "MEASURED", max(5, 95 - i // 6), 1.0] for i in range(480)]
+        return {"calendarDate": day, "maxStressLevel": 80, "avgStressLevel": 32,
+                "stressValuesArray": stress, "bodyBatteryValuesArray": battery}
+
+    def get_body_battery(self, start: str, end: str | None = None):
+        self._call("get_body_battery")
+        days = self._days(start, end or start)
+        return [{"date": d, "charged": 60, "drained": 55,
+                 "bodyBatteryValuesArray": [[day_start_ms(d) + i * 180_000, max(5, 95 - i // 6)] for i in range(480)]}
+                for d in days]
+
+    def get_respiration_data(self, day: str):
+        self._call("get_respiration_data")
+        rng = self._rng("resp", day)
+        start = day_start_ms(day)
+        return {"calendarDate": day, "avgWakingRespirationValue": 15.0, "avgSleepRespirationValue": 13.0,
+                "respirationValuesArray": [[start + i * 120_000, round(rng.uniform(11, 20), 1)] for i in range(720)]}
+
+    def get_stats(self, day: str):
+        self._call("get_stats")
+        return self._stats(day)
+
+    def get_user_summary(self, day: str):
+        self._call("get_user_summary")
+        return self._stats(day)
+
+    def _stats(self, day: str) -> dict:
+        rng = self._rng("stats", day)
+        return {"calendarDate": day, "totalSteps": rng.randint(2000, 20000), "totalKilocalories": rng.randint(1800, 3500),
+                "restingHeartRate": rng.randint(44, 58), "averageStressLevel": rng.randint(15, 45),
+                "floorsAscended": rng.randint(0, 30), "moderateIntensityMinutes": rng.randint(0, 60),
+                "vigorousIntensityMinutes": rng.randint(0, 40)}
+
+    def get_steps_data(self, day: str):
+        self._call("get_steps_data")
+        rng = self._rng("steps", day)
+        start = day_start_ms(day)
+        return [{"startGMT": start + i * 900_000, "endGMT": start + (i + 1) * 900_000, "steps": rng.randint(0, 1500)}
+                for i in range(96)]
+
+    def get_daily_steps(self, start: str, end: str):
+        self._call("get_daily_steps")
+        return [{"calendarDate": d, "totalSteps": self._rng("steps", d).randint(2000, 20000), "stepGoal": 8000}
+                for d in self._days(start, end)]
+
+    def get_training_readiness(self, day: str):
+        self._call("get_training_readiness")
+        return [{"calendarDate": day, "score": self._rng("tr", day).randint(20, 95), "level": "MODERATE"}]
+
+    def get_spo2_data(self, day: str):
+        self._call("get_spo2_data")
+        return {"calendarDate": day, "averageSpO2": 95.0, "lowestSpO2": 89}
+
+    # Activities
+
+    def get_activities(self, start: int = 0, limit: int = 20):
+        self._call("get_activities")
+        return [self._activity(i) for i in range(start, min(start + limit, self.activities))]
+
+    def get_last_activity(self):
+        self._call("get_last_activity")
+        return self._activity(0) if self.activities else None
+
+    def get_activities_fordate(self, day: str):
+        self._call("get_activities_fordate")
+        return {"ActivitiesForDay": {"payload": []}}
+
+    def _activity(self, index: int) -> dict:
+        rng = self._rng("activity", index)
+        activity_id = 15_000_000_000 - index * 7919
+        start = datetime.now(timezone.utc) - timedelta(hours=index * 30)
+        return {
+            "activityId": activity_id,
+            "activityName": rng.choice(["Morning Run", "Easy Run", "Intervals", "Long Ride", "Pool Swim"]),
+            "startTimeGMT": start.strftime("%Y-%m-%d %H:%M:%S"),
+            "activityType": {"typeKey": rng.choice(["running", "cycling", "lap_swimming"])},
+            "distance": round(rng.uniform(3000, 40000), 1),
+            "duration": round(rng.uniform(1200, 7200), 1),
+            "averageHR": rng.randint(120, 165),
+            "maxHR": rng.randint(165, 190),
+        }
+
+    def get_activity_details(self, activity_id: int, maxchart: int = 2000, maxpoly: int = 4000):
+        self._call("get_activity_details")
+        rng = self._rng("details", activity_id)
+        points = min(maxchart, 1200)
+        return {
+            "activityId": activity_id,
+            "metricDescriptors": [{"key": "directTimestamp", "metricsIndex": 0},
+                                  {"key": "directHeartRate", "metricsIndex": 1},
+                                  {"key": "directSpeed", "metricsIndex": 2}],
+            "activityDetailMetrics": [
+                {"metrics": [i * 5000, rng.randint(110, 185), round(rng.uniform(2, 5), 2)]} for i in range(points)
+            ],
+        }
+
+    def get_activity_splits(self, activity_id: int):
+        self._call("get_activity_splits")
+        rng = self._rng("splits", activity_id)
+        return {"activityId": activity_id, "lapDTOs": [
+            {"lapIndex": i, "distance": 1000.0, "duration": round(rng.uniform(240, 360), 1),
+             "averageHR": rng.randint(130, 170)} for i in range(rng.randint(3, 20))
+        ]}
+
+    def get_activity_hr_in_timezones(self, activity_id: int):
+        self._call("get_activity_hr_in_timezones")
+        return [{"zoneNumber": z, "secsInZone": self._rng("zones", activity_id, z).randint(0, 1800)} for z in range(1, 6)]
+
+    def _days(self, start: str, end: str) -> list[str]:
+        first, last = date.fromisoformat(start), date.fromisoformat(end)
+        return [(first + timedelta(days=i)).isoformat() for i in range((last - first).days + 1)]
+
+    def __getattr__(self, name: str):
+        # Any other Garmin method: a small generic payload after the usual
+        # latency and failures.
+        if not name.startswith("get_"):
+            raise AttributeError(name)
+
+        def method(*args):
+            self._call(name)
+            return {"method": name, "args": list(args)}
+
+        method.__name__ = name
+        return method
@@ -0,0 +1,229 @@
+"""
+Benchmarks for garmin-service, run entirely offline.
+
+Starts the service in a child process with FakeGarmin behind the session
+pool, fires each scenario at it from a pool of concurrent clients and
+reports throughput, p50/p99 latency, the service's peak memory and how
+many upstream calls it made.
+
+Usage (from garmin-service/):
+    python -m bench.run
+    python -m bench.run --scenarios single,bundle --concurrency 64 --latency 0.3
+    python -m bench.run --throttle-rate 0.05 --error-rate 0.02 --json results.json
+
+Scenarios:
+    single  - /sleep and /hr for one date each, every request a different date
+    hot     - every request for the same few dates (cache and coalescing)
+    range   - /hrv and compact 15-minute /hr over 31-day ranges
+    bundle  - /bundle of sleep, hr and hrv over 14-day ranges
+    export  - /activities/export of 100 activities with details and splits
+
+The service reads its usual environment variables (SERVER_MODE, WORKERS,
+...) from this process. The response cache and history store are off
+unless --cache / --history, so every scenario measures the upstream path.
+Peak memory is the service's resident high-water mark during a scenario
+(Linux only).
+"""
+
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from pathlib import Path
+
+SERVICE_DIR = Path(__file__).resolve().parent.parent
+
+
+def serve(port: int, env: dict, fake_options: dict, ready):
+    """Child process: run the service against FakeGarmin until killed."""
+    os.environ.update(env)
+    sys.path.insert(0, str(SERVICE_DIR))
+    import main
+    from bench.fake_garmin import FakeGarmin
+
+    main.logger.setLevel("ERROR")
+    main.sessions.set(main.DEFAULT_ACCOUNT, FakeGarmin(**fake_options))
+    server = main.create_server()
+    ready.set()
+    server.serve_forever()
+
+
+def day_paths(rng: random.Random, n: int, span: int = 0) -> list[tuple[date, date]]:
+    """n random (start, end) windows of span extra days within the last three years."""
+    today = date.today()
+    windows = []
+    for _ in range(n):
+        start = today - timedelta(days=rng.randint(span + 2, 3 * 365))
+        windows.append((start, start + timedelta(days=span)))
+    return windows
+
+
+def scenario_paths(name: str, n: int, rng: random.Random) -> list[str]:
+    if name == "single":
+        return [
+            f"/{'sleep' if i % 2 else 'hr'}?date={start}"
+            for i, (start, _) in enumerate(day_paths(rng, n))
+        ]
+    if name == "hot":
+        days = [start for start, _ in day_paths(rng, 4)]
+        return [f"/hr?date={rng.choice(days)}" for _ in range(n)]
+    if name == "range":
+        return [
+            f"/hrv?start={start}&end={end}" if i % 2 else f"/hr?start={start}&end={end}&compact=true&resolution=15m"
+            for i, (start, end) in enumerate(day_paths(rng, n, span=30))
+        ]
+    if name == "bundle":
+        return [f"/bundle?start={start}&end={end}&metrics=sleep,hr,hrv" for start, end in day_paths(rng, n, span=13)]
+    if name == "export":
+        return ["/activities/export?all=true&limit=100&include=details,splits" for _ in range(n)]
+    raise ValueError(f"Unknown scenario: {name}")
+
+
+def fetch(port: int, path: str) -> tuple[float, int, int]:
+    """One request: (seconds, status, body bytes)."""
+    started = time.perf_counter()
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=300)
+    try:
+        conn.request("GET", path)
+        response = conn.getresponse()
+        body = response.read()
+        return time.perf_counter() - started, response.status, len(body)
+    except OSError:
+        return time.perf_counter() - started, 0, 0
+    finally:
+        conn.close()
+
+
+def get_json(port: int, path: str) -> dict:
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    try:
+        conn.request("GET", path)
+        return json.loads(conn.getresponse().read())
+    finally:
+        conn.close()
+
+
+def reset_peak_memory(pid: int):
+    """Reset the process's resident high-water mark, where the kernel allows it."""
+    try:
+        Path(f"/proc/{pid}/clear_refs").write_text("5")
+    except OSError:
+        pass
+
+
+def peak_memory_mb(pid: int) -> float | None:
+    try:
+        for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+            if line.startswith("VmHWM:"):
+                return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+def percentile(values: list[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))]
+
+
+def run_scenario(name: str, port: int, pid: int, args, rng: random.Random) -> dict:
+    paths = scenario_paths(name, args.requests, rng)
+    calls_before = get_json(port, "/upstream/stats")["calls"]
+    reset_peak_memory(pid)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as clients:
+        results = list(clients.map(lambda path: fetch(port, path), paths))
+    elapsed = time.perf_counter() - started
+
+    latencies = [seconds for seconds, _, _ in results]
+    return {
+        "scenario": name,
+        "requests": len(results),
+        "errors": sum(1 for _, status, _ in results if not 200 <= status < 300),
+        "rps": round(len(results) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        "peak_mb": peak_memory_mb(pid),
+        "mb_sent": round(sum(size for _, _, size in results) / 1e6, 1),
+        "upstream_calls": get_json(port, "/upstream/stats")["calls"] - calls_before,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default="single,hot,range,bundle,export")
+    parser.add_argument("--concurrency", type=int, default=32, help="concurrent clients (default: 32)")
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario (default: 200)")
+    parser.add_argument("--port", type=int, default=3911)
+    parser.add_argument("--latency", type=float, default=0.2, help="mean fake upstream latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.25, help="+/- fraction around the latency")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="chance of a 429 per upstream call")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="chance of a 503 per upstream call")
+    parser.add_argument("--disconnect-rate", type=float, default=0.0, help="chance of a dropped connection")
+    parser.add_argument("--upstream-rate", type=float, default=1000,
+                        help="UPSTREAM_RATE for the service, high so the fake's latency is the limit (default: 1000)")
+    parser.add_argument("--cache", action="store_true", help="leave the response cache on")
+    parser.add_argument("--history", action="store_true", help="leave the history store on")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", metavar="FILE", help="also write the results to FILE")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="garmin-bench-")
+    env = {
+        "PORT": str(args.port),
+        "GARMINTOKENS": str(Path(workdir) / "tokens"),
+        "STATE_DIR": str(Path(workdir) / "state"),
+        "CACHE_DIR": str(Path(workdir) / "cache"),
+        "UPSTREAM_RATE": str(args.upstream_rate),
+        "UPSTREAM_BURST": str(int(args.upstream_rate * 2)),
+        "RETRY_BASE_DELAY": os.getenv("RETRY_BASE_DELAY", "0.05"),
+    }
+    if not args.cache:
+        env["CACHE_MAX_MB"] = "0"
+    if not args.history:
+        env["HISTORY_ENABLED"] = "false"
+    fake_options = {
+        "latency": args.latency,
+        "jitter": args.jitter,
+        "throttle_rate": args.throttle_rate,
+        "error_rate": args.error_rate,
+        "disconnect_rate": args.disconnect_rate,
+        "seed": args.seed,
+    }
+
+    ctx = multiprocessing.get_context("spawn")
+    ready = ctx.Event()
+    server = ctx.Process(target=serve, args=(args.port, env, fake_options, ready), daemon=True)
+    server.start()
+    if not ready.wait(30):
+        sys.exit("Service didn't start")
+
+    rng = random.Random(args.seed)
+    results = []
+    try:
+        print(f"{'scenario':<10}{'requests':>9}{'errors':>8}{'req/s':>9}{'p50 ms':>10}{'p99 ms':>10}"
+              f"{'peak MB':>9}{'MB sent':>9}{'upstream':>10}")
+        for name in args.scenarios.split(","):
+            result = run_scenario(name, args.port, server.pid, args, rng)
+            results.append(result)
+            print(f"{name:<10}{result['requests']:>9}{result['errors']:>8}{result['rps']:>9}"
+                  f"{result['p50_ms']:>10}{result['p99_ms']:>10}{str(result['peak_mb']):>9}"
+                  f"{result['mb_sent']:>9}{result['upstream_calls']:>10}")
+    finally:
+        server.terminate()
+        server.join()
+
+    if args.json:
+        Path(args.json).write_text(json.dumps({"options": vars(args), "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
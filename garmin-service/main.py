@@ -15,19 +15,65 @@ Environment Variables:
     GARMINTOKENS - Path to token storage directory (default: /data/.garminconnect)
     PORT - Server port (default: 3011)
     API_KEY - API key for authentication
+    SERVER_MODE - "threaded" (default), "async" for an asyncio front end, or "single" for the old one-at-a-time server
+    WORKERS - Number of request worker threads (default: 8)
+    QUEUE_SIZE - Connections allowed to wait for a worker before 503s (default: 32)
+    REQUEST_TIMEOUT - Seconds a connection may wait or idle before it is dropped (default: 60)
+    UPSTREAM_CONCURRENCY - Max concurrent Garmin Connect calls (default: 8)
+    UPSTREAM_RATE - Sustained Garmin Connect calls per second (default: 10)
+    UPSTREAM_BURST - Calls allowed back-to-back before UPSTREAM_RATE applies (default: 20)
+    UPSTREAM_RETRIES - Retries of one transient upstream failure (default: 3)
+    REQUEST_RETRY_BUDGET - Upstream retries shared by all calls of one request (default: 10)
+    RETRY_BASE_DELAY - Initial retry backoff in seconds, doubled per attempt (default: 0.5)
+    RETRY_MAX_DELAY - Cap on a single retry backoff in seconds (default: 30)
+    MAX_RANGE_DAYS - Longest start/end range a single request may ask for (default: 366)
+    ACCOUNTS_DIR - Token directories of accounts other than the default (default: garmin-accounts next to GARMINTOKENS)
+    MAX_SESSIONS - Logged-in accounts kept in memory at once (default: 16)
+    SESSION_IDLE_TIMEOUT - Seconds before an unused account session is dropped (default: 1800)
+    TOKEN_REFRESH_MARGIN - Seconds before expiry to refresh a session's OAuth2 token (default: 900)
+    TOKEN_REFRESH_INTERVAL - Seconds between checks for expiring OAuth2 tokens (default: 60)
+    STATE_DIR - Sync cursors and other service state (default: garmin-state next to GARMINTOKENS)
+    BACKFILL_CONCURRENCY - Days fetched at once by backfill jobs, across all jobs (default: 4)
+    HISTORY_ENABLED - Keep a local history of fetched metrics in STATE_DIR (default: true)
+    SLEEP_NEED_HOURS - Nightly sleep target that sleep debt is counted against (default: 8)
+    CACHE_DIR - Response cache directory (default: garmin-cache next to GARMINTOKENS)
+    CACHE_MAX_MB - Response cache size before LRU eviction, 0 disables it (default: 256)
+    CACHE_SHORT_TTL - Seconds to keep still-changing days such as today (default: 900)
+    TIMING_HEADERS - Add a Server-Timing header to JSON responses (default: false)
+    DEFAULT_TIMEZONE - IANA timezone that decides "today" when a request names none (default: UTC)
 """
 
+import asyncio
+import gzip
+import hashlib
+import io
+import itertools
 import json
 import logging
 import os
+import queue
+import random
+import re
+import socket
+import sqlite3
 import sys
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
 from datetime import date, datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from pathlib import Path
-from typing import Any
+from typing import Any, Callable, Hashable, Iterable, Iterator
 from urllib.parse import parse_qs, urlparse
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
-import garth
+import requests
 from garminconnect import Garmin
 
 logging.basicConfig(
@@ -36,8 +82,6 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-api: Garmin | None = None
-
 
 class Config:
     email: str | None = os.getenv("GARMIN_EMAIL")
@@ -46,16 +90,1222 @@ class Config:
     port: int = int(os.getenv("PORT", "3011"))
     admin_key: str | None = os.getenv("GARMIN_ADMIN_KEY")
 
-    today: date = datetime.now(timezone.utc).date()
-    week_start: date = today - timedelta(days=7)
+    server_mode: str = os.getenv("SERVER_MODE", "threaded")
+    workers: int = int(os.getenv("WORKERS", "8"))
+    queue_size: int = int(os.getenv("QUEUE_SIZE", "32"))
+    request_timeout: float = float(os.getenv("REQUEST_TIMEOUT", "60"))
+    upstream_concurrency: int = int(os.getenv("UPSTREAM_CONCURRENCY", "8"))
+    upstream_rate: float = float(os.getenv("UPSTREAM_RATE", "10"))
+    upstream_burst: int = int(os.getenv("UPSTREAM_BURST", "20"))
+    upstream_retries: int = int(os.getenv("UPSTREAM_RETRIES", "3"))
+    request_retry_budget: int = int(os.getenv("REQUEST_RETRY_BUDGET", "10"))
+    retry_base_delay: float = float(os.getenv("RETRY_BASE_DELAY", "0.5"))
+    retry_max_delay: float = float(os.getenv("RETRY_MAX_DELAY", "30"))
+    max_range_days: int = int(os.getenv("MAX_RANGE_DAYS", "366"))
+
+    accounts_dir: str = os.getenv("ACCOUNTS_DIR") or str(Path(tokenstore).parent / "garmin-accounts")
+    max_sessions: int = int(os.getenv("MAX_SESSIONS", "16"))
+    session_idle_timeout: float = float(os.getenv("SESSION_IDLE_TIMEOUT", "1800"))
+    token_refresh_margin: float = float(os.getenv("TOKEN_REFRESH_MARGIN", "900"))
+    token_refresh_interval: float = float(os.getenv("TOKEN_REFRESH_INTERVAL", "60"))
+
+    state_dir: str = os.getenv("STATE_DIR") or str(Path(tokenstore).parent / "garmin-state")
+    backfill_concurrency: int = int(os.getenv("BACKFILL_CONCURRENCY", "4"))
+    history_enabled: bool = os.getenv("HISTORY_ENABLED", "true").lower() not in ("0", "false", "no")
+    sleep_need_hours: float = float(os.getenv("SLEEP_NEED_HOURS", "8"))
+    cache_dir: str = os.getenv("CACHE_DIR") or str(Path(tokenstore).parent / "garmin-cache")
+    cache_max_bytes: int = int(float(os.getenv("CACHE_MAX_MB", "256")) * 1024 * 1024)
+    cache_short_ttl: float = float(os.getenv("CACHE_SHORT_TTL", "900"))
+
+    timing_headers: bool = os.getenv("TIMING_HEADERS", "false").lower() in ("1", "true", "yes")
+    default_timezone: str = os.getenv("DEFAULT_TIMEZONE", "UTC")
 
 
 config = Config()
 
 
-def get_mfa() -> str:
-    """Get MFA token from user input."""
-    return input("MFA one-time code: ")
+# Requests without an X-Garmin-Account header or ?account= use this account,
+# whose tokens live in GARMINTOKENS.
+DEFAULT_ACCOUNT = "default"
+ACCOUNT_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+TOKEN_FILES = ["oauth1_token.json", "oauth2_token.json"]
+
+# The account the current request is for, carried into upstream pool threads
+# by fan_out like retry_budget.
+current_account: ContextVar[str] = ContextVar("current_account", default=DEFAULT_ACCOUNT)
+
+# The timezone the current request's "today" is in, from X-Timezone or ?tz=.
+request_timezone: ContextVar[ZoneInfo] = ContextVar("request_timezone", default=ZoneInfo(config.default_timezone))
+
+# Garmin dates days by the wearer's local calendar, which can be anywhere
+# from UTC-12 to UTC+14 whatever timezone a request names.
+EARLIEST_TIMEZONE = timezone(timedelta(hours=-12))
+
+
+def today() -> date:
+    """The current date in the request's timezone, worked out per call."""
+    return datetime.now(request_timezone.get()).date()
+
+
+def week_start() -> date:
+    """Default start of a range: a week before today."""
+    return today() - timedelta(days=7)
+
+
+# Upper bounds in seconds of the latency histogram buckets.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def format_labels(names: tuple[str, ...], values: tuple) -> str:
+    if not names:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, escaped)) + "}"
+
+
+class Counter:
+    """Monotonic counter with labels, rendered in Prometheus text format."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *label_values, amount: float = 1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            return [f"{self.name}{format_labels(self.labels, k)} {v}" for k, v in self._values.items()]
+
+
+class Gauge(Counter):
+    """Value that goes up and down, e.g. requests in flight."""
+
+    kind = "gauge"
+
+    def dec(self, *label_values, amount: float = 1):
+        self.inc(*label_values, amount=-amount)
+
+
+class Histogram:
+    """Latency histogram with labels, cumulative buckets as Prometheus expects."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # label values -> (per-bucket counts, sum, count)
+        self._values: dict[tuple, tuple[list[int], float, int]] = {}
+
+    def observe(self, value: float, *label_values):
+        with self._lock:
+            counts, total, n = self._values.get(label_values) or ([0] * len(self.buckets), 0.0, 0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[label_values] = (counts, total + value, n + 1)
+
+    @contextmanager
+    def time(self, *label_values):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *label_values)
+
+    def samples(self) -> list[str]:
+        lines = []
+        with self._lock:
+            for label_values, (counts, total, n) in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    labels = format_labels(self.labels + ("le",), label_values + (bound,))
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = format_labels(self.labels + ("le",), label_values + ("+Inf",))
+                lines.append(f"{self.name}_bucket{labels} {n}")
+                lines.append(f"{self.name}_sum{format_labels(self.labels, label_values)} {total}")
+                lines.append(f"{self.name}_count{format_labels(self.labels, label_values)} {n}")
+        return lines
+
+
+request_duration = Histogram(
+    "garmin_http_request_duration_seconds", "Time to handle a request, by route, HTTP method and status.",
+    ("route", "method", "status"),
+)
+requests_in_flight = Gauge("garmin_http_requests_in_flight", "Requests being handled right now.")
+response_bytes = Counter(
+    "garmin_http_response_bytes_total", "Bytes written to clients, headers included, by route.", ("route",)
+)
+upstream_duration = Histogram(
+    "garmin_upstream_call_duration_seconds",
+    "Time of each Garmin Connect call attempt, by client method and outcome (ok or the HTTP status).",
+    ("method", "outcome"),
+)
+upstream_in_flight = Gauge("garmin_upstream_calls_in_flight", "Garmin Connect calls in progress.")
+upstream_retries = Counter("garmin_upstream_retries_total", "Retried Garmin Connect calls, by client method.", ("method",))
+format_duration = Histogram(
+    "garmin_format_duration_seconds", "Time spent reshaping upstream payloads, by function.", ("function",),
+    buckets=(0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25),
+)
+
+METRICS = [
+    request_duration, requests_in_flight, response_bytes,
+    upstream_duration, upstream_in_flight, upstream_retries, format_duration,
+]
+
+
+class RequestTiming:
+    """Time one request spends in upstream calls and formatting, for Server-Timing.
+
+    Upstream time is summed over calls, so with calls running in parallel it
+    can exceed the request's wall time.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.upstream = 0.0
+        self.upstream_calls = 0
+        self.format = 0.0
+
+    def add(self, kind: str, seconds: float):
+        with self._lock:
+            setattr(self, kind, getattr(self, kind) + seconds)
+            if kind == "upstream":
+                self.upstream_calls += 1
+
+    def header(self) -> str:
+        total = time.perf_counter() - self.started
+        return (
+            f'upstream;dur={self.upstream * 1000:.1f};desc="{self.upstream_calls} calls", '
+            f"format;dur={self.format * 1000:.1f}, total;dur={total * 1000:.1f}"
+        )
+
+
+# Timing of the request being handled, shared with its upstream pool tasks.
+request_timing: ContextVar[RequestTiming | None] = ContextVar("request_timing", default=None)
+
+
+@contextmanager
+def timed_format(function: Callable):
+    """Record the time spent in a payload formatting function."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        format_duration.observe(elapsed, function.__name__)
+        timing = request_timing.get()
+        if timing is not None:
+            timing.add("format", elapsed)
+
+
+class SessionPool:
+    """Authenticated Garmin clients, one per account.
+
+    Each account keeps its tokens in its own directory: GARMINTOKENS for the
+    default account, ACCOUNTS_DIR/<account> for the rest. Sessions are logged
+    in lazily from those tokens on first use, dropped once idle for
+    SESSION_IDLE_TIMEOUT, and capped at MAX_SESSIONS with the least recently
+    used evicted first - an evicted account just logs back in from its
+    tokens next time. A background thread refreshes each live session's
+    OAuth2 token TOKEN_REFRESH_MARGIN before it expires, so requests don't
+    pay for the refresh. Within a session every worker thread shares the same
+    client; a semaphore shared by all sessions caps how many upstream calls
+    run at once so parallel handlers don't starve the connection pools.
+    """
+
+    def __init__(self, max_concurrency: int, max_sessions: int, idle_timeout: float):
+        self._lock = threading.Lock()
+        self._clients: OrderedDict[str, tuple[Garmin, float]] = OrderedDict()
+        self._login_locks: dict[str, threading.Lock] = {}
+        self._states: dict[str, str] = {}
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._max_concurrency = max_concurrency
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+
+    def tokenstore(self, account: str) -> Path:
+        if account == DEFAULT_ACCOUNT:
+            return Path(config.tokenstore)
+        return Path(config.accounts_dir) / account
+
+    def get(self, account: str) -> Garmin | None:
+        """The account's client, logging in from stored tokens if needed."""
+        with self._lock:
+            self._evict_idle()
+            client = self._touch(account)
+            if client is not None:
+                return client
+        return self.login(account, lambda: login_from_tokens(self.tokenstore(account)))
+
+    def login(self, account: str, login: Callable[[], Garmin | None]) -> Garmin | None:
+        """Log an account in with `login` unless it already has a session.
+
+        One login per account at a time; anyone else waiting picks up the
+        session it created. Exceptions from `login` are recorded as a failed
+        login and re-raised.
+        """
+        with self._lock:
+            login_lock = self._login_locks.setdefault(account, threading.Lock())
+
+        with login_lock:
+            with self._lock:
+                client = self._touch(account)
+                if client is not None:
+                    return client
+                self._states[account] = "logging_in"
+            try:
+                client = login()
+            except Exception:
+                with self._lock:
+                    self._states[account] = "failed"
+                    self._drop_login_lock(account, login_lock)
+                raise
+            if client is None:
+                with self._lock:
+                    # Token files that didn't log in are stale; no files at all
+                    # is just an account nobody has authenticated yet.
+                    if self._has_tokens(account):
+                        self._states[account] = "stale"
+                    else:
+                        self._states.pop(account, None)
+                    self._drop_login_lock(account, login_lock)
+            else:
+                self.set(account, client)
+            return client
+
+    def status(self, account: str) -> dict:
+        """Auth state of an account without logging it in or waiting on a login.
+
+        One of authenticated (live session), logging_in, stored (tokens on
+        disk, loaded on next use), stale (stored tokens were rejected),
+        failed (last login raised) or unauthenticated.
+        """
+        with self._lock:
+            entry = self._clients.get(account)
+            state = self._states.get(account)
+        if entry is not None:
+            state = "authenticated"
+        elif state is None:
+            state = "stored" if self._has_tokens(account) else "unauthenticated"
+        expires_at = token_expires_at(entry[0]) if entry is not None else None
+        return {
+            "authenticated": state in ("authenticated", "stored"),
+            "auth_state": state,
+            "token_expires_at": (
+                datetime.fromtimestamp(expires_at, timezone.utc).isoformat() if expires_at else None
+            ),
+        }
+
+    def refresh_expiring(self, margin: float):
+        """Refresh the OAuth2 token of every session within `margin` seconds of expiry.
+
+        Runs the refresh under the account's login lock so requests never see
+        a half-swapped token, and stores the new tokens so a restart or an
+        evicted session picks them up too.
+        """
+        with self._lock:
+            clients = [(account, client) for account, (client, _) in self._clients.items()]
+
+        for account, client in clients:
+            expires_at = token_expires_at(client)
+            if expires_at is None or expires_at - time.time() > margin:
+                continue
+            with self._lock:
+                login_lock = self._login_locks.setdefault(account, threading.Lock())
+            with login_lock:
+                try:
+                    rate_limiter.acquire(config.retry_max_delay)
+                    garth_client(client).refresh_oauth2()
+                    save_tokens(client, self.tokenstore(account))
+                    logger.info(f"Refreshed OAuth2 token for account {account}")
+                except Exception as e:
+                    # Leave the session alone; a request that fails with the old
+                    # token still falls back to logging in from stored tokens.
+                    logger.warning(f"Failed to refresh OAuth2 token for account {account}: {e}")
+
+    def _drop_login_lock(self, account: str, login_lock: threading.Lock):
+        """Forget an account's login lock after a login that gave no session.
+
+        Callers can name any account, so keeping a lock for each one that
+        never logged in would grow without bound. Anyone already waiting
+        holds the lock itself and still gets it. Call with self._lock held.
+        """
+        if self._login_locks.get(account) is login_lock:
+            del self._login_locks[account]
+
+    def _has_tokens(self, account: str) -> bool:
+        tokenstore = self.tokenstore(account)
+        return any((tokenstore / f).exists() for f in TOKEN_FILES)
+
+    def set(self, account: str, client: Garmin):
+        """Add or replace an account's client, sizing its connection pool for our workers."""
+        garth_client = getattr(client, "garth", None)
+        if garth_client is not None:
+            garth_client.configure(
+                pool_connections=self._max_concurrency,
+                pool_maxsize=self._max_concurrency,
+            )
+        with self._lock:
+            self._clients[account] = (client, time.monotonic())
+            self._clients.move_to_end(account)
+            self._states.pop(account, None)
+            while len(self._clients) > self.max_sessions:
+                evicted, _ = self._clients.popitem(last=False)
+                logger.info(f"Evicted session for account {evicted}")
+
+    def _touch(self, account: str) -> Garmin | None:
+        entry = self._clients.get(account)
+        if entry is None:
+            return None
+        self._clients[account] = (entry[0], time.monotonic())
+        self._clients.move_to_end(account)
+        return entry[0]
+
+    def _evict_idle(self):
+        cutoff = time.monotonic() - self.idle_timeout
+        # Ordered least recently used first, so stop at the first fresh one.
+        while self._clients:
+            account, (_, last_used) = next(iter(self._clients.items()))
+            if last_used > cutoff:
+                break
+            del self._clients[account]
+            logger.info(f"Dropped idle session for account {account}")
+
+    @contextmanager
+    def slot(self):
+        """Hold one of the upstream call slots for the duration of the block."""
+        with self._slots:
+            yield
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "sessions": len(self._clients),
+                "max_sessions": self.max_sessions,
+                "accounts": list(self._clients),
+            }
+
+
+sessions = SessionPool(config.upstream_concurrency, config.max_sessions, config.session_idle_timeout)
+
+
+class RateLimiter:
+    """Adaptive token bucket shared by every upstream call.
+
+    Allows `burst` calls back-to-back, then refills at the current rate.
+    acquire() blocks until a token is available. When Garmin throttles us
+    the rate is halved (and paused for any Retry-After), then crept back up
+    towards the configured rate with each successful call. A caller that
+    can't wait out a long pause passes max_wait and fails instead.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, max_wait: float | None = None):
+        """Take a token, raising a transient 429 UpstreamError if that takes over max_wait seconds."""
+        deadline = None if max_wait is None else time.monotonic() + max_wait
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                else:
+                    self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            if deadline is not None and now + wait > deadline:
+                raise UpstreamError(
+                    f"Error: Garmin asked us to back off, {wait:.0f}s left", 429, True, retry_after=wait
+                )
+            time.sleep(wait)
+
+    def throttled(self, retry_after: float | None = None):
+        """Back off after Garmin pushed back with a 429."""
+        with self._lock:
+            self.rate = max(self.max_rate / 16, self.rate / 2)
+            self._tokens = 0
+            if retry_after:
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+        logger.warning(f"Garmin throttled us, upstream rate now {self.rate:.2f}/s")
+
+    def succeeded(self):
+        """Creep back towards the configured rate."""
+        if self.rate < self.max_rate:
+            with self._lock:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+rate_limiter = RateLimiter(config.upstream_rate, config.upstream_burst)
+
+# Shared pool for fanning a request out into per-day upstream calls. Its size
+# bounds the fan-out across all requests, not just within one.
+upstream_pool = ThreadPoolExecutor(
+    max_workers=config.upstream_concurrency, thread_name_prefix="upstream"
+)
+
+
+class ResponseCache:
+    """On-disk cache of raw upstream responses, keyed by endpoint and date.
+
+    Entries live in a small SQLite database so they survive restarts. Each
+    entry either never expires (finalized past days) or carries an expiry
+    time (days Garmin may still be updating). When the stored payloads grow
+    past max_bytes the least recently used entries are evicted.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._db: sqlite3.Connection | None = None
+        self._size = 0
+
+        if max_bytes <= 0:
+            return
+
+        try:
+            Path(directory).mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(
+                str(Path(directory) / "responses.sqlite3"),
+                check_same_thread=False,
+                isolation_level=None,
+            )
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS responses (
+                    endpoint TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    payload BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    expires_at REAL,
+                    accessed_at REAL NOT NULL,
+                    PRIMARY KEY (endpoint, key)
+                )
+                """
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_lru ON responses (accessed_at)")
+            self._size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        except (OSError, sqlite3.Error) as e:
+            logger.warning(f"Response cache disabled, could not open {directory}: {e}")
+            self._db = None
+
+    @property
+    def enabled(self) -> bool:
+        return self._db is not None
+
+    def get(self, endpoint: str, key: str) -> tuple[bool, Any]:
+        """Return (found, value) for a cached response."""
+        if not self._db:
+            return False, None
+
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT payload, expires_at FROM responses WHERE endpoint = ? AND key = ?",
+                (endpoint, key),
+            ).fetchone()
+            if row is None or (row[1] is not None and row[1] <= now):
+                self.misses += 1
+                return False, None
+
+            self._db.execute(
+                "UPDATE responses SET accessed_at = ? WHERE endpoint = ? AND key = ?",
+                (now, endpoint, key),
+            )
+            self.hits += 1
+        return True, json.loads(row[0])
+
+    def put(self, endpoint: str, key: str, value: Any, ttl: float | None):
+        """Store a response, kept forever when ttl is None."""
+        if not self._db:
+            return
+
+        payload = json.dumps(value, default=str).encode()
+        now = time.time()
+        expires_at = None if ttl is None else now + ttl
+        with self._lock:
+            previous = self._db.execute(
+                "SELECT size FROM responses WHERE endpoint = ? AND key = ?",
+                (endpoint, key),
+            ).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (endpoint, key, payload, len(payload), expires_at, now),
+            )
+            self._size += len(payload) - (previous[0] if previous else 0)
+            self._evict()
+
+    def _evict(self):
+        """Drop expired, then least recently used, entries until under budget."""
+        if self._size <= self.max_bytes:
+            return
+
+        self._db.execute("DELETE FROM responses WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),))
+        self._size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+        # Trim to 90% so we don't evict again on the very next write.
+        target = self.max_bytes * 0.9
+        rows = self._db.execute("SELECT endpoint, key, size FROM responses ORDER BY accessed_at")
+        doomed = []
+        for endpoint, key, size in rows:
+            if self._size <= target:
+                break
+            doomed.append((endpoint, key))
+            self._size -= size
+        self._db.executemany("DELETE FROM responses WHERE endpoint = ? AND key = ?", doomed)
+        self.evictions += len(doomed)
+
+    def clear(self, account: str):
+        """Forget an account's responses, e.g. after it switched Garmin logins.
+
+        Endpoints are stored as "<account>/<method>".
+        """
+        if not self._db:
+            return
+        prefix = f"{account}/"
+        with self._lock:
+            self._db.execute(
+                "DELETE FROM responses WHERE substr(endpoint, 1, ?) = ?",
+                (len(prefix), prefix),
+            )
+            self._size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0] if self._db else 0
+            return {
+                "enabled": self.enabled,
+                "entries": entries,
+                "bytes": self._size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+cache = ResponseCache(config.cache_dir, config.cache_max_bytes)
+
+
+class SyncCursor:
+    """Per-account record of which days of which metrics a client has synced.
+
+    A day's metric is "final" once Garmin won't revise it any more (see
+    cache_ttl). /sync hands out the (day, metric) pairs that aren't final yet
+    under a cursor id; only when the client commits that cursor are they
+    recorded, so a sync that dies halfway gets the same days offered again.
+    Uncommitted cursors are forgotten after a day. It also remembers which
+    activities /activities/export has already sent each account.
+
+    If the database can't be opened the store is disabled: reads find
+    nothing, writes are dropped and the endpoints that need it answer 503.
+    """
+
+    CURSOR_TTL = 86400
+
+    def __init__(self, directory: str):
+        self._lock = threading.Lock()
+        self._db: sqlite3.Connection | None = None
+
+        try:
+            Path(directory).mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(
+                str(Path(directory) / "sync.sqlite3"),
+                check_same_thread=False,
+                isolation_level=None,
+            )
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS synced (
+                    account TEXT NOT NULL,
+                    metric TEXT NOT NULL,
+                    day TEXT NOT NULL,
+                    final INTEGER NOT NULL,
+                    synced_at REAL NOT NULL,
+                    PRIMARY KEY (account, metric, day)
+                )
+                """
+            )
+            self._db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS pending (
+                    cursor TEXT NOT NULL,
+                    account TEXT NOT NULL,
+                    metric TEXT NOT NULL,
+                    day TEXT NOT NULL,
+                    final INTEGER NOT NULL,
+                    created_at REAL NOT NULL
+                )
+                """
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS pending_cursor ON pending (cursor)")
+            self._db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS exported_activities (
+                    account TEXT NOT NULL,
+                    activity_id INTEGER NOT NULL,
+                    exported_at REAL NOT NULL,
+                    PRIMARY KEY (account, activity_id)
+                ) WITHOUT ROWID
+                """
+            )
+        except (OSError, sqlite3.Error) as e:
+            logger.warning(f"Sync state disabled, could not open {directory}: {e}")
+            self._db = None
+
+    @property
+    def enabled(self) -> bool:
+        return self._db is not None
+
+    def synced(self, account: str, start: date, end: date) -> dict[tuple[str, str], bool]:
+        """{(day, metric): final} for everything committed between start and end."""
+        if not self._db:
+            return {}
+
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT day, metric, final FROM synced WHERE account = ? AND day BETWEEN ? AND ?",
+                (account, start.isoformat(), end.isoformat()),
+            ).fetchall()
+        return {(day, metric): bool(final) for day, metric, final in rows}
+
+    def stage(self, account: str, entries: list[tuple[str, str, bool]]) -> str:
+        """Hold (day, metric, final) entries under a new cursor id until committed."""
+        cursor = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._db.execute("DELETE FROM pending WHERE created_at < ?", (now - self.CURSOR_TTL,))
+            self._db.executemany(
+                "INSERT INTO pending VALUES (?, ?, ?, ?, ?, ?)",
+                [(cursor, account, metric, day, int(final), now) for day, metric, final in entries],
+            )
+        return cursor
+
+    def commit(self, account: str, cursor: str) -> int | None:
+        """Record a cursor's entries as synced; None if the cursor is unknown."""
+        if not self._db:
+            return None
+
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                rows = self._db.execute(
+                    "SELECT metric, day, final FROM pending WHERE cursor = ? AND account = ?",
+                    (cursor, account),
+                ).fetchall()
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO synced VALUES (?, ?, ?, ?, ?)",
+                    [(account, metric, day, final, now) for metric, day, final in rows],
+                )
+                self._db.execute("DELETE FROM pending WHERE cursor = ?", (cursor,))
+                self._db.execute("COMMIT")
+            except sqlite3.Error:
+                self._db.execute("ROLLBACK")
+                raise
+        return len(rows) if rows else None
+
+    def exported(self, account: str, activity_ids: list[int]) -> set[int]:
+        """The subset of activity_ids already exported to the account."""
+        if not self._db or not activity_ids:
+            return set()
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT activity_id FROM exported_activities WHERE account = ? "
+                f"AND activity_id IN ({', '.join('?' * len(activity_ids))})",
+                [account, *activity_ids],
+            ).fetchall()
+        return {activity_id for (activity_id,) in rows}
+
+    def mark_exported(self, account: str, activity_id: int):
+        if not self._db:
+            return
+
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO exported_activities VALUES (?, ?, ?)",
+                (account, activity_id, time.time()),
+            )
+
+    def reset(self, account: str):
+        """Forget everything an account has synced."""
+        if not self._db:
+            return
+
+        with self._lock:
+            self._db.execute("DELETE FROM synced WHERE account = ?", (account,))
+            self._db.execute("DELETE FROM pending WHERE account = ?", (account,))
+            self._db.execute("DELETE FROM exported_activities WHERE account = ?", (account,))
+
+
+sync_cursor = SyncCursor(config.state_dir)
+
+
+# History fields the derived metrics are computed from: (metric, field) -> input.
+DERIVED_INPUTS: dict[tuple[str, str], str] = {
+    ("hrv_data", "lastNightAvg"): "hrv",
+    ("hrv_data", "lowUpper"): "hrv_low_upper",
+    ("hrv_data", "balancedLow"): "hrv_balanced_low",
+    ("hrv_data", "balancedUpper"): "hrv_balanced_upper",
+    ("sleep_data", "total_hours"): "sleep_hours",
+    ("heart_rates", "resting_hr"): "resting_hr",
+}
+DERIVED_METRICS = {metric for metric, _ in DERIVED_INPUTS}
+
+# Longest window of any derived metric, in days. resting_hr_28d_avg looks
+# at the DERIVED_WINDOW days before the day rather than up to it, so a
+# stored day changes the derived values of itself and the DERIVED_WINDOW
+# days after it.
+DERIVED_WINDOW = 28
+
+
+def derive_day(inputs: dict[date, dict[str, float]], day: date, sleep_need: float) -> dict[str, float]:
+    """The derived metrics of one day, from the inputs of it and the days before.
+
+    - hrv_7d_avg / hrv_28d_avg: mean nightly HRV over the last 7 / 28 days,
+      with the latest baseline band (hrv_low_upper, hrv_balanced_low,
+      hrv_balanced_upper) to compare them against
+    - sleep_7d_avg_hours, and sleep_debt_7d_hours: hours short of
+      sleep_need summed over the last 7 nights
+    - resting_hr_7d_avg, resting_hr_28d_avg over the 28 days before this
+      one, and resting_hr_delta: this day's resting HR minus that average
+    """
+    def window(name: str, days: int, offset: int = 0) -> list[float]:
+        values = (inputs.get(day - timedelta(days=i), {}).get(name) for i in range(offset, offset + days))
+        return [v for v in values if v is not None]
+
+    def mean(values: list[float]) -> float | None:
+        return round(sum(values) / len(values), 2) if values else None
+
+    derived = {
+        "hrv_7d_avg": mean(window("hrv", 7)),
+        "hrv_28d_avg": mean(window("hrv", DERIVED_WINDOW)),
+        "sleep_7d_avg_hours": mean(window("sleep_hours", 7)),
+        "resting_hr_7d_avg": mean(window("resting_hr", 7)),
+        "resting_hr_28d_avg": mean(window("resting_hr", DERIVED_WINDOW, offset=1)),
+    }
+    for band in ("hrv_low_upper", "hrv_balanced_low", "hrv_balanced_upper"):
+        latest = window(band, DERIVED_WINDOW)
+        derived[band] = latest[0] if latest else None
+
+    nights = window("sleep_hours", 7)
+    if nights:
+        derived["sleep_debt_7d_hours"] = round(sum(max(0.0, sleep_need - h) for h in nights), 2)
+    resting_hr = inputs.get(day, {}).get("resting_hr")
+    if resting_hr is not None and derived["resting_hr_28d_avg"] is not None:
+        derived["resting_hr_delta"] = round(resting_hr - derived["resting_hr_28d_avg"], 2)
+    return {name: value for name, value in derived.items() if value is not None}
+
+
+def hrv_status(derived: dict[str, float]) -> str | None:
+    """Where the 7-day HRV average sits against the baseline band, Garmin style."""
+    average = derived.get("hrv_7d_avg")
+    low, high = derived.get("hrv_balanced_low"), derived.get("hrv_balanced_upper")
+    if average is None or low is None or high is None:
+        return None
+    if average < derived.get("hrv_low_upper", float("-inf")):
+        return "low"
+    return "balanced" if low <= average <= high else "unbalanced"
+
+
+class HistoryStore:
+    """Local copy of every account's metrics, for range queries without Garmin.
+
+    Two narrow tables, both clustered on their primary key so a range of
+    one metric's days (or one series' samples) is a single contiguous scan:
+    daily holds the numeric fields of each day's payload, samples the
+    intraday series at full resolution. Rows are written whenever a day is
+    fetched from Garmin Connect and replaced when Garmin revises it.
+
+    A third table, derived, holds derive_day()'s metrics per day. Storing a
+    day recomputes only the days whose windows it falls in, in the same
+    transaction; the whole table is rebuilt only when it's new or the
+    sleep need it was computed with has changed.
+    """
+
+    def __init__(self, directory: str, enabled: bool, sleep_need: float = 8.0):
+        self._lock = threading.Lock()
+        self._db: sqlite3.Connection | None = None
+        self.sleep_need = sleep_need
+
+        if not enabled:
+            return
+
+        try:
+            Path(directory).mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(
+                str(Path(directory) / "history.sqlite3"),
+                check_same_thread=False,
+                isolation_level=None,
+            )
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS daily (
+                    account TEXT NOT NULL,
+                    metric TEXT NOT NULL,
+                    field TEXT NOT NULL,
+                    day TEXT NOT NULL,
+                    value REAL NOT NULL,
+                    PRIMARY KEY (account, metric, field, day)
+                ) WITHOUT ROWID
+                """
+            )
+            self._db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS samples (
+                    account TEXT NOT NULL,
+                    series TEXT NOT NULL,
+                    ts INTEGER NOT NULL,
+                    value REAL NOT NULL,
+                    PRIMARY KEY (account, series, ts)
+                ) WITHOUT ROWID
+                """
+            )
+            self._db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS derived (
+                    account TEXT NOT NULL,
+                    day TEXT NOT NULL,
+                    field TEXT NOT NULL,
+                    value REAL NOT NULL,
+                    PRIMARY KEY (account, day, field)
+                ) WITHOUT ROWID
+                """
+            )
+            self._db.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            self._rebuild_derived()
+        except (OSError, sqlite3.Error) as e:
+            logger.warning(f"History store disabled, could not open {directory}: {e}")
+            self._db = None
+
+    @property
+    def enabled(self) -> bool:
+        return self._db is not None
+
+    def record(self, account: str, metric: str, day: date, fields: dict[str, float],
+               series: dict[str, tuple[list, list]], spans: dict[str, tuple[int, int]] | None = None):
+        """Replace one day of a metric: its daily fields and intraday (times, values).
+
+        spans gives each series' (first, last) timestamp in the payload,
+        gaps included; stored samples in that span are replaced wholesale.
+        """
+        if not self._db:
+            return
+
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                # Fields Garmin dropped in a revision shouldn't linger.
+                self._db.execute(
+                    "DELETE FROM daily WHERE account = ? AND metric = ? AND day = ?",
+                    (account, metric, day.isoformat()),
+                )
+                self._db.executemany(
+                    "INSERT INTO daily VALUES (?, ?, ?, ?, ?)",
+                    [(account, metric, field, day.isoformat(), value) for field, value in fields.items()],
+                )
+                for name, (times, values) in series.items():
+                    # Likewise samples Garmin has since blanked out.
+                    first, last = (spans or {}).get(name) or (min(times, default=0), max(times, default=-1))
+                    self._db.execute(
+                        "DELETE FROM samples WHERE account = ? AND series = ? AND ts BETWEEN ? AND ?",
+                        (account, name, first, last),
+                    )
+                    self._db.executemany(
+                        "INSERT OR REPLACE INTO samples VALUES (?, ?, ?, ?)",
+                        [(account, name, t, v) for t, v in zip(times, values)],
+                    )
+                if metric in DERIVED_METRICS:
+                    self._derive(account, day, day + timedelta(days=DERIVED_WINDOW))
+                self._db.execute("COMMIT")
+            except sqlite3.Error:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def daily(self, account: str, metric: str, start: date, end: date,
+              fields: list[str] | None = None) -> dict[str, dict[str, float]]:
+        """{day: {field: value}} for every stored day of a metric in the range."""
+        if not self._db:
+            return {}
+
+        sql = "SELECT day, field, value FROM daily WHERE account = ? AND metric = ? AND day BETWEEN ? AND ?"
+        params: list = [account, metric, start.isoformat(), end.isoformat()]
+        if fields:
+            sql += f" AND field IN ({', '.join('?' * len(fields))})"
+            params += fields
+        with self._lock:
+            rows = self._db.execute(sql + " ORDER BY day", params).fetchall()
+
+        days: dict[str, dict[str, float]] = {}
+        for day, field, value in rows:
+            days.setdefault(day, {})[field] = value
+        return days
+
+    def _derived_inputs(self, account: str, start: date, end: date) -> dict[date, dict[str, float]]:
+        """{day: {input: value}} of DERIVED_INPUTS, one key range scan per field."""
+        inputs: dict[date, dict[str, float]] = {}
+        for (metric, field), name in DERIVED_INPUTS.items():
+            rows = self._db.execute(
+                "SELECT day, value FROM daily WHERE account = ? AND metric = ? AND field = ? AND day BETWEEN ? AND ?",
+                (account, metric, field, start.isoformat(), end.isoformat()),
+            )
+            for day, value in rows:
+                inputs.setdefault(date.fromisoformat(day), {})[name] = value
+        return inputs
+
+    def _derive(self, account: str, start: date, end: date):
+        """Recompute the derived rows of start..end. Call with the lock held.
+
+        Only days with inputs of their own get rows, so one old day coming
+        in doesn't fill the following weeks with derived-only days.
+        """
+        inputs = self._derived_inputs(account, start - timedelta(days=DERIVED_WINDOW), end)
+        self._db.execute(
+            "DELETE FROM derived WHERE account = ? AND day BETWEEN ? AND ?",
+            (account, start.isoformat(), end.isoformat()),
+        )
+        self._db.executemany(
+            "INSERT INTO derived VALUES (?, ?, ?, ?)",
+            [
+                (account, day.isoformat(), field, value)
+                for day in inputs if start <= day <= end
+                for field, value in derive_day(inputs, day, self.sleep_need).items()
+            ],
+        )
+
+    def _rebuild_derived(self):
+        """Recompute every account's derived table if it may be out of date."""
+        sleep_need = str(self.sleep_need)
+        stored = self._db.execute("SELECT value FROM settings WHERE key = 'sleep_need'").fetchone()
+        if stored and stored[0] == sleep_need:
+            return
+
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                spans = self._db.execute(
+                    "SELECT account, MIN(day), MAX(day) FROM daily "
+                    f"WHERE metric IN ({', '.join('?' * len(DERIVED_METRICS))}) GROUP BY account",
+                    sorted(DERIVED_METRICS),
+                ).fetchall()
+                for account, first, last in spans:
+                    self._derive(account, date.fromisoformat(first), date.fromisoformat(last))
+                self._db.execute("INSERT OR REPLACE INTO settings VALUES ('sleep_need', ?)", (sleep_need,))
+                self._db.execute("COMMIT")
+            except sqlite3.Error:
+                self._db.execute("ROLLBACK")
+                raise
+        if spans:
+            logger.info(f"Rebuilt derived metrics for {len(spans)} account(s)")
+
+    def derived(self, account: str, start: date, end: date,
+                fields: list[str] | None = None) -> dict[str, dict[str, Any]]:
+        """{day: {field: value}} of the stored derived metrics, with each day's hrv_status."""
+        if not self._db:
+            return {}
+
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT day, field, value FROM derived WHERE account = ? AND day BETWEEN ? AND ? ORDER BY day",
+                (account, start.isoformat(), end.isoformat()),
+            ).fetchall()
+
+        days: dict[str, dict[str, Any]] = {}
+        for day, field, value in rows:
+            days.setdefault(day, {})[field] = value
+        for values in days.values():
+            status = hrv_status(values)
+            if status:
+                values["hrv_status"] = status
+        if fields:
+            days = {day: {f: v for f, v in values.items() if f in fields} for day, values in days.items()}
+        return days
+
+    # How aggregate() groups days: period -> SQL expression over `day`.
+    PERIODS = {
+        "day": "day",
+        "week": "date(day, '-6 days', 'weekday 1')",
+        "month": "substr(day, 1, 7)",
+        "year": "substr(day, 1, 4)",
+        "all": "'all'",
+    }
+
+    def aggregate(self, account: str, metric: str, field: str, start: date, end: date,
+                  period: str) -> list[dict]:
+        """count/min/max/mean/sum of one field per period (weeks start on Monday)."""
+        if not self._db:
+            return []
+
+        group = self.PERIODS[period]
+        with self._lock:
+            rows = self._db.execute(
+                f"""
+                SELECT {group} AS period, COUNT(*), MIN(value), MAX(value), AVG(value), SUM(value)
+                FROM daily
+                WHERE account = ? AND metric = ? AND field = ? AND day BETWEEN ? AND ?
+                GROUP BY period ORDER BY period
+                """,
+                (account, metric, field, start.isoformat(), end.isoformat()),
+            ).fetchall()
+        return [
+            {"period": p, "count": n, "min": lo, "max": hi, "mean": round(mean, 2), "sum": total}
+            for p, n, lo, hi, mean, total in rows
+        ]
+
+    def series(self, account: str, name: str, start_ms: int, end_ms: int, step: int | None) -> dict:
+        """Samples of a series in [start_ms, end_ms), raw or bucketed by `step` ms.
+
+        Bucketed results use the same columns as ?resolution= on the live
+        endpoints, minus "last".
+        """
+        if not self._db:
+            return {"times": [], "values": []}
+
+        with self._lock:
+            if step is None:
+                rows = self._db.execute(
+                    "SELECT ts, value FROM samples WHERE account = ? AND series = ? AND ts >= ? AND ts < ?",
+                    (account, name, start_ms, end_ms),
+                ).fetchall()
+                return {"times": [r[0] for r in rows], "values": [r[1] for r in rows]}
+
+            rows = self._db.execute(
+                """
+                SELECT ts - ts % ? AS bucket, MIN(value), MAX(value), AVG(value), COUNT(*)
+                FROM samples
+                WHERE account = ? AND series = ? AND ts >= ? AND ts < ?
+                GROUP BY bucket ORDER BY bucket
+                """,
+                (step, account, name, start_ms, end_ms),
+            ).fetchall()
+        return {
+            "start": [r[0] for r in rows],
+            "step": step,
+            "min": [r[1] for r in rows],
+            "max": [r[2] for r in rows],
+            "mean": [round(r[3], 1) for r in rows],
+            "count": [r[4] for r in rows],
+        }
+
+    def clear(self, account: str):
+        """Forget an account's history, e.g. after it switched Garmin logins."""
+        if not self._db:
+            return
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                for table in ("daily", "samples", "derived"):
+                    self._db.execute(f"DELETE FROM {table} WHERE account = ?", (account,))
+                self._db.execute("COMMIT")
+            except sqlite3.Error:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def stats(self, account: str) -> dict:
+        """What's stored for an account: day span per metric field, sample span per series."""
+        if not self._db:
+            return {"enabled": False, "daily": {}, "series": {}}
+
+        with self._lock:
+            daily = self._db.execute(
+                """
+                SELECT metric, field, COUNT(*), MIN(day), MAX(day) FROM daily
+                WHERE account = ? GROUP BY metric, field
+                """,
+                (account,),
+            ).fetchall()
+            series = self._db.execute(
+                """
+                SELECT series, COUNT(*), MIN(ts), MAX(ts) FROM samples
+                WHERE account = ? GROUP BY series
+                """,
+                (account,),
+            ).fetchall()
+
+        metrics: dict[str, dict] = {}
+        for metric, field, n, first, last in daily:
+            metrics.setdefault(metric, {})[field] = {"days": n, "first": first, "last": last}
+        return {
+            "enabled": True,
+            "daily": metrics,
+            "series": {name: {"samples": n, "first": first, "last": last} for name, n, first, last in series},
+        }
+
+
+history = HistoryStore(config.state_dir, config.history_enabled, config.sleep_need_hours)
+
+
+def login_from_tokens(tokenstore: Path) -> Garmin | None:
+    """Log in with the tokens stored in a directory, None if there are none or they're stale."""
+    if not any((tokenstore / f).exists() for f in TOKEN_FILES):
+        return None
+
+    logger.info(f"Loading tokens from {tokenstore}")
+    try:
+        garmin = Garmin()
+        garmin.login(str(tokenstore))
+        logger.info("Successfully authenticated with stored tokens")
+        return garmin
+    except Exception as e:
+        logger.warning(f"Failed to use stored tokens: {e}")
+        return None
+
+
+def garth_client(garmin: Garmin):
+    """The garth client behind a Garmin session.
+
+    garminconnect 0.3 replaced it with a client of its own, whose tokens
+    this service can't store or refresh, so fail loudly there rather than
+    after Garmin has already accepted a login.
+    """
+    client = getattr(garmin, "garth", None)
+    if client is None:
+        raise RuntimeError("Garmin client has no garth session; garminconnect 0.3+ is not supported, install <0.3")
+    return client
+
+
+def save_tokens(garmin: Garmin, tokenstore: Path):
+    """Store a client's tokens in its own account's directory."""
+    tokenstore.mkdir(parents=True, exist_ok=True)
+    garth_client(garmin).dump(str(tokenstore))
+
+
+def token_expires_at(garmin: Garmin) -> float | None:
+    """Epoch seconds at which a client's OAuth2 token expires, None if unknown."""
+    token = getattr(getattr(garmin, "garth", None), "oauth2_token", None)
+    return getattr(token, "expires_at", None)
 
 
 def init_api() -> Garmin:
@@ -63,18 +1313,9 @@ def init_api() -> Garmin:
     tokenstore = Path(config.tokenstore)
     tokenstore.mkdir(parents=True, exist_ok=True)
 
-    token_files = ["oauth1_token.json", "oauth2_token.json"]
-    has_tokens = any((tokenstore / f).exists() for f in token_files)
-
-    if has_tokens:
-        logger.info(f"Loading tokens from {tokenstore}")
-        try:
-            garmin = Garmin()
-            garmin.login(str(tokenstore))
-            logger.info("Successfully authenticated with stored tokens")
-            return garmin
-        except Exception as e:
-            logger.warning(f"Failed to use stored tokens: {e}")
+    garmin = login_from_tokens(tokenstore)
+    if garmin is not None:
+        return garmin
 
     if not config.email or not config.password:
         raise ValueError("GARMIN_EMAIL and GARMIN_PASSWORD must be set for initial login")
@@ -82,8 +1323,9 @@ def init_api() -> Garmin:
     logger.info("Initiating new login")
     try:
         garmin = Garmin(config.email, config.password)
+        garth_client(garmin)
         token1, token2 = garmin.login("")
-        garth.save(str(tokenstore))
+        save_tokens(garmin, tokenstore)
         logger.info("Successfully authenticated and stored tokens")
         return garmin
     except Exception as e:
@@ -91,13 +1333,297 @@ def init_api() -> Garmin:
         raise
 
 
-def safe_api_call(method, *args, **kwargs) -> tuple[bool, Any, str | None]:
-    """Safely call an API method with error handling."""
+def parse_retry_after(header: str | None) -> float | None:
+    """Seconds to wait from a Retry-After header, in seconds or HTTP-date form."""
+    if not header:
+        return None
+    header = header.strip()
+    if header.isdigit():
+        return float(header)
     try:
-        result = method(*args, **kwargs)
-        return True, result, None
+        when = parsedate_to_datetime(header)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, when.timestamp() - time.time())
+
+
+class UpstreamError(Exception):
+    """A failed Garmin Connect call, classified for retries and for callers.
+
+    Transient failures (throttling, 5xx, timeouts, dropped connections) may
+    well succeed if tried again; permanent ones (bad credentials, other 4xx,
+    anything unrecognised) won't.
+    """
+
+    def __init__(self, message: str, status: int | None = None, transient: bool = False,
+                 retry_after: float | None = None):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+        self.transient = transient
+        self.retry_after = retry_after
+
+    @property
+    def throttled(self) -> bool:
+        return self.status == 429
+
+    @classmethod
+    def from_exception(cls, e: Exception) -> "UpstreamError":
+        """Classify an exception raised by garminconnect/garth/requests.
+
+        The HTTP status is usually buried: garminconnect re-raises its own
+        exceptions from garth's, which wrap the requests HTTPError, so walk
+        the whole chain looking for a response.
+        """
+        status = None
+        retry_after = None
+        network = False
+
+        current: BaseException | None = e
+        for _ in range(10):
+            if current is None:
+                break
+            if isinstance(current, (requests.ConnectionError, requests.Timeout)):
+                network = True
+            for holder in (current, getattr(current, "error", None)):
+                response = getattr(holder, "response", None)
+                if status is None and response is not None and getattr(response, "status_code", None):
+                    status = response.status_code
+                    retry_after = parse_retry_after((getattr(response, "headers", None) or {}).get("Retry-After"))
+            current = current.__cause__ or current.__context__
+
+        name = type(e).__name__
+        if status is None and "TooManyRequests" in name:
+            status = 429
+        if status is None and "Authentication" in name:
+            status = 401
+
+        transient = network or status in (408, 429) or (status is not None and status >= 500)
+        return cls(f"Error: {e}", status, transient, retry_after)
+
+    def to_dict(self) -> dict:
+        return {"error": self.message, "status": self.status, "transient": self.transient}
+
+
+class RetryBudget:
+    """Retries one client request may spend across all its upstream calls.
+
+    Without it a 31-day range against a struggling Garmin would retry every
+    day several times over; with it the request fails fast once the budget
+    is gone.
+    """
+
+    def __init__(self, retries: int):
+        self.remaining = retries
+        self._lock = threading.Lock()
+
+    def take(self) -> bool:
+        with self._lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+
+# Set per client request, and carried into upstream pool threads by fan_out.
+retry_budget: ContextVar[RetryBudget | None] = ContextVar("retry_budget", default=None)
+
+
+class SingleFlight:
+    """Collapses concurrent identical calls into one.
+
+    The first caller for a key runs the call; anyone asking for the same key
+    while it is still in flight waits for and shares its result (or its
+    exception) instead of making the call again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._in_flight: dict[Hashable, Future] = {}
+        self.calls = 0
+        self.collapsed = 0
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self._in_flight[key] = Future()
+                self.calls += 1
+            else:
+                self.collapsed += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            future.set_result(fn())
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+        return future.result()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "collapsed": self.collapsed,
+                "in_flight": len(self._in_flight),
+            }
+
+
+single_flight = SingleFlight()
+
+
+def safe_api_call(method, *args, **kwargs) -> tuple[bool, Any, UpstreamError | None]:
+    """Safely call an API method with error handling.
+
+    Transient failures are retried with exponential backoff and full jitter,
+    up to UPSTREAM_RETRIES times and while the request's retry budget lasts.
+    A Retry-After longer than RETRY_MAX_DELAY fails the call straight away,
+    as does any call made while the rate limiter is paused for longer than
+    that (or than REQUEST_TIMEOUT).
+    Identical calls (same client, method and arguments) already in flight
+    are joined rather than repeated, so callers share the result object and
+    must not modify it.
+    """
+    key = (id(getattr(method, "__self__", None)), method.__name__, args, tuple(sorted(kwargs.items())))
+    budget = retry_budget.get()
+
+    def call():
+        attempt = 0
+        while True:
+            # Wait for the rate limiter before taking a slot, so a long
+            # Retry-After pause fails this call instead of pinning a slot.
+            rate_limiter.acquire(min(config.retry_max_delay, config.request_timeout))
+            with sessions.slot():
+                started = time.perf_counter()
+                outcome = "error"
+                upstream_in_flight.inc()
+                try:
+                    result = method(*args, **kwargs)
+                except Exception as e:
+                    error = UpstreamError.from_exception(e)
+                    outcome = str(error.status or "error")
+                else:
+                    rate_limiter.succeeded()
+                    outcome = "ok"
+                    return result
+                finally:
+                    upstream_in_flight.dec()
+                    elapsed = time.perf_counter() - started
+                    upstream_duration.observe(elapsed, method.__name__, outcome)
+                    timing = request_timing.get()
+                    if timing is not None:
+                        timing.add("upstream", elapsed)
+
+            if error.throttled:
+                rate_limiter.throttled(error.retry_after)
+            if not error.transient or attempt >= config.upstream_retries:
+                raise error
+            if (error.retry_after or 0) > config.retry_max_delay:
+                # Don't hold a worker for Garmin's whole back-off; the rate
+                # limiter already pauses the calls that come after this one.
+                raise error
+            if budget is not None and not budget.take():
+                raise error
+
+            attempt += 1
+            upstream_retries.inc(method.__name__)
+            delay = random.uniform(0, min(config.retry_max_delay, config.retry_base_delay * 2 ** attempt))
+            logger.info(f"Retrying {method.__name__} {list(args)} in {delay:.1f}s after {error}")
+            time.sleep(max(delay, error.retry_after or 0))
+
+    try:
+        return True, single_flight.do(key, call), None
+    except UpstreamError as e:
+        return False, None, e
     except Exception as e:
-        return False, None, f"Error: {e}"
+        return False, None, UpstreamError.from_exception(e)
+
+
+# Days after which an empty or unscored day is taken as final: Garmin has
+# nothing more coming for it (no HRV device, a night without the watch).
+PROVISIONAL_DAYS = 7
+
+
+def cache_ttl(endpoint: str, day: date, result: Any) -> float | None:
+    """How long a response for `day` can be cached, None meaning forever.
+
+    Garmin keeps revising today and yesterday (late syncs, overnight
+    processing), and only scores a night's sleep (and works out its HRV)
+    some time after waking, so those get a short TTL. Empty and unscored
+    days get one too until they are PROVISIONAL_DAYS old. Anything older
+    is final. Entries are shared by requests in any timezone, so "today"
+    is taken in the timezone furthest behind: a day only counts as final
+    once it is over everywhere.
+    """
+    today = datetime.now(EARLIEST_TIMEZONE).date()
+    if day >= today - timedelta(days=1):
+        return config.cache_short_ttl
+    if day < today - timedelta(days=PROVISIONAL_DAYS):
+        return None
+    if not result:
+        return config.cache_short_ttl
+    if endpoint == "get_sleep_data" and not (result.get("dailySleepDTO") or {}).get("sleepScores"):
+        return config.cache_short_ttl
+    if endpoint == "get_hrv_data" and not result.get("hrvSummary"):
+        return config.cache_short_ttl
+    return None
+
+
+def cached_api_call(method, *dates: date) -> tuple[bool, Any, UpstreamError | None]:
+    """Call a date-keyed API method, going through the response cache.
+
+    The dates are passed to the method as ISO strings; the newest one decides
+    how fresh the cached response has to be. Entries are per account.
+    """
+    endpoint = f"{current_account.get()}/{method.__name__}"
+    key = "|".join(d.isoformat() for d in dates)
+
+    found, result = cache.get(endpoint, key)
+    if found:
+        return True, result, None
+
+    success, result, error = safe_api_call(method, *(d.isoformat() for d in dates))
+    if success:
+        cache.put(endpoint, key, result, cache_ttl(method.__name__, max(dates), result))
+        if len(dates) == 1 and isinstance(result, dict):
+            record_history(method.__name__, dates[0], result)
+    return success, result, error
+
+
+def fan_out(fn, items: Iterable, pool: ThreadPoolExecutor | None = None,
+            window: int | None = None) -> Iterator:
+    """Run fn over items on the upstream pool, yielding results in order.
+
+    Only a small window of items is in flight at a time, so a long range
+    being streamed out never holds more than a few finished days in memory.
+    """
+    pool = pool or upstream_pool
+    window = window or config.upstream_concurrency * 2
+    items = iter(items)
+
+    # Each task runs in a copy of the caller's context, so it uses the same
+    # request's account and retry budget.
+    def submit(item):
+        return pool.submit(copy_context().run, fn, item)
+
+    pending = deque(submit(item) for item in itertools.islice(items, window))
+    while pending:
+        future = pending.popleft()
+        for item in itertools.islice(items, 1):
+            pending.append(submit(item))
+        yield future.result()
+
+
+def date_range(start: date, end: date) -> list[date]:
+    """Every date from start to end, inclusive."""
+    return [start + timedelta(days=i) for i in range((end - start).days + 1)]
 
 
 def get_date_param(query: dict, param: str, default: date) -> date:
@@ -155,28 +1681,52 @@ def format_sleep_data(raw: dict) -> dict:
     }
 
 
-def format_heart_rate_data(raw: dict) -> dict:
-    """Format heart rate data into per-minute timeseries."""
-    heart_rates = raw.get("heartRateValues") or []
+def format_heart_rate_data(raw: dict, compact: bool = False, include_raw: bool = False) -> dict:
+    """Format heart rate data into per-minute timeseries.
 
-    timeseries = []
-    for hr in heart_rates:
-        timestamp_ms = hr[0]
-        bpm = hr[1]
-        dt = datetime.fromtimestamp(timestamp_ms / 1000, timezone.utc)
-        timeseries.append({
-            "time": dt.isoformat(),
-            "bpm": bpm,
-        })
+    The default timeseries is a list of {time, bpm} objects. With compact,
+    it is instead parallel columns: a start time and step in epoch ms plus a
+    bpm array (nulls kept), falling back to an explicit times array if the
+    samples aren't evenly spaced. The upstream payload is only echoed back
+    under "raw" when asked for.
+    """
+    heart_rates = raw.get("heartRateValues") or []
 
-    return {
+    if isinstance(heart_rates, dict):
+        # Already aggregated into buckets by reduce_series.
+        timeseries = heart_rates
+    elif compact:
+        times = [hr[0] for hr in heart_rates]
+        step = times[1] - times[0] if len(times) > 1 else None
+        regular = step is not None and all(b - a == step for a, b in zip(times, times[1:]))
+        timeseries = {
+            "start": times[0] if times else None,
+            "step": step if regular else None,
+            "bpm": [hr[1] for hr in heart_rates],
+        }
+        if not regular and len(times) > 1:
+            timeseries["times"] = times
+    else:
+        timeseries = []
+        for hr in heart_rates:
+            timestamp_ms = hr[0]
+            bpm = hr[1]
+            dt = datetime.fromtimestamp(timestamp_ms / 1000, timezone.utc)
+            timeseries.append({
+                "time": dt.isoformat(),
+                "bpm": bpm,
+            })
+
+    payload = {
         "date": raw.get("calendarDate", ""),
         "resting_hr": raw.get("restingHeartRate"),
         "max_hr": raw.get("maxHeartRate"),
         "min_hr": raw.get("minHeartRate"),
         "timeseries": timeseries,
-        "raw": raw
     }
+    if include_raw:
+        payload["raw"] = raw
+    return payload
 
 
 def format_hrv_data(raw: list[dict]) -> list[dict] | None:
@@ -204,24 +1754,1112 @@ def format_hrv_data(raw: list[dict]) -> list[dict] | None:
     return timeseries
 
 
+# Intraday series inside raw Garmin payloads that can be downsampled:
+# Garmin method -> [(field, index of the value within each sample)]. Every
+# sample starts with its epoch-ms timestamp.
+SERIES_FIELDS: dict[str, list[tuple[str, int]]] = {
+    "get_heart_rates": [("heartRateValues", 1)],
+    "get_all_day_stress": [("stressValuesArray", 1), ("bodyBatteryValuesArray", 2)],
+    "get_body_battery": [("bodyBatteryValuesArray", 1)],
+    "get_respiration_data": [("respirationValuesArray", 1)],
+}
+
+
+def parse_resolution(value: str) -> int | None:
+    """Bucket size in ms for ?resolution= (e.g. 5m, 15m, 1h), None for "day"."""
+    if value == "day":
+        return None
+    units = {"m": 60_000, "h": 3_600_000}
+    if len(value) < 2 or value[-1] not in units or not value[:-1].isdigit() or int(value[:-1]) <= 0:
+        raise ValueError(f"Invalid resolution: {value} (use e.g. 5m, 15m, 1h or day)")
+    return int(value[:-1]) * units[value[-1]]
+
+
+def valid_samples(samples: list, value_index: int) -> tuple[list, list]:
+    """Split samples into timestamp and value columns, dropping gaps.
+
+    Garmin marks missing readings with null and, for stress, body battery
+    and respiration, with negative sentinels (-1 off wrist, -2 activity).
+    """
+    times = []
+    values = []
+    for sample in samples:
+        value = sample[value_index] if len(sample) > value_index else None
+        if value is None or value < 0:
+            continue
+        times.append(sample[0])
+        values.append(value)
+    return times, values
+
+
+def bucket_series(samples: list, value_index: int, step: int | None) -> dict:
+    """Aggregate samples into fixed-width time buckets, one column per stat.
+
+    With step None the whole series becomes a single bucket (daily stats).
+    Samples are assumed to be in time order, as Garmin returns them.
+    """
+    times, values = valid_samples(samples, value_index)
+    starts, mins, maxs, sums, lasts, counts = [], [], [], [], [], []
+    for t, v in zip(times, values):
+        start = times[0] if step is None else t - t % step
+        if starts and starts[-1] == start:
+            if v < mins[-1]:
+                mins[-1] = v
+            if v > maxs[-1]:
+                maxs[-1] = v
+            sums[-1] += v
+            lasts[-1] = v
+            counts[-1] += 1
+        else:
+            starts.append(start)
+            mins.append(v)
+            maxs.append(v)
+            sums.append(v)
+            lasts.append(v)
+            counts.append(1)
+
+    return {
+        "start": starts,
+        "step": step,
+        "min": mins,
+        "max": maxs,
+        "mean": [round(total / n, 1) for total, n in zip(sums, counts)],
+        "last": lasts,
+        "count": counts,
+    }
+
+
+def lttb(samples: list, value_index: int, threshold: int) -> list:
+    """Largest-triangle-three-buckets downsampling to at most `threshold` points.
+
+    Keeps the visual shape of the series for plotting. Returns [time, value]
+    pairs; gaps are dropped rather than interpolated.
+    """
+    times, values = valid_samples(samples, value_index)
+    n = len(times)
+    if threshold >= n or threshold < 3:
+        return [[t, v] for t, v in zip(times, values)]
+
+    sampled = [[times[0], values[0]]]
+    every = (n - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        # Average of the next bucket is the third corner of the triangle.
+        next_start = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        span = next_end - next_start
+        avg_t = sum(times[next_start:next_end]) / span
+        avg_v = sum(values[next_start:next_end]) / span
+
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        at, av = times[a], values[a]
+        best_area = -1.0
+        best = start
+        for j in range(start, end):
+            area = abs((at - avg_t) * (values[j] - av) - (at - times[j]) * (avg_v - av))
+            if area > best_area:
+                best_area = area
+                best = j
+        sampled.append([times[best], values[best]])
+        a = best
+
+    sampled.append([times[-1], values[-1]])
+    return sampled
+
+
+def check_series_options(query: dict):
+    """Raise ValueError for a bad ?resolution=, ?downsample= or ?points=.
+
+    Range handlers call this before fetching anything, so a streamed
+    response can still answer 400 rather than an error line per day.
+    """
+    resolution = query.get("resolution", [None])[0]
+    if resolution:
+        parse_resolution(resolution)
+    downsample = query.get("downsample", [None])[0]
+    if downsample and downsample != "lttb":
+        raise ValueError(f"Invalid downsample: {downsample} (use lttb)")
+    points = query.get("points", [None])[0]
+    if points is not None:
+        try:
+            int(points)
+        except ValueError:
+            raise ValueError(f"Invalid points: {points} (use a whole number)") from None
+
+
+def reduce_series(method_name: str, result: Any, query: dict) -> Any:
+    """Apply ?resolution= or ?downsample=lttb to a raw payload's series.
+
+    With resolution, each series is replaced by bucketed min/max/mean/last/
+    count columns. With downsample=lttb (and optional points, default 200)
+    it keeps its [time, value] shape but is thinned out for plotting. The
+    cached payload is never modified; changed dicts are copies.
+    """
+    check_series_options(query)
+    fields = SERIES_FIELDS.get(method_name)
+    resolution = query.get("resolution", [None])[0]
+    downsample = query.get("downsample", [None])[0]
+    if not fields or not result or not (resolution or downsample):
+        return result
+
+    if resolution:
+        step = parse_resolution(resolution)
+        reduce = lambda samples, index: bucket_series(samples, index, step)
+    else:
+        points = int(query.get("points", ["200"])[0])
+        reduce = lambda samples, index: lttb(samples, index, points)
+
+    def reduce_day(payload: dict) -> dict:
+        payload = dict(payload)
+        for field, index in fields:
+            if isinstance(payload.get(field), list):
+                payload[field] = reduce(payload[field], index)
+        return payload
+
+    # get_body_battery returns a list of days, the rest a single day.
+    if isinstance(result, list):
+        return [reduce_day(day) if isinstance(day, dict) else day for day in result]
+    return reduce_day(result)
+
+
+# Endpoints that return one day of data: path -> (Garmin method, formatter).
+# Each takes ?date=, or ?start=&end= to fetch a whole range in one request.
+DAILY_ENDPOINTS: dict[str, tuple[str, Callable[[Any], Any] | None]] = {
+    "/user/summary": ("get_user_summary", None),
+    "/stats": ("get_stats", None),
+    "/stats/body": ("get_stats_and_body", None),
+    "/heart-rate": ("get_heart_rates", None),
+    "/resting-heart-rate": ("get_resting_heart_rate", None),
+    "/steps": ("get_steps_data", None),
+    "/sleep": ("get_sleep_data", format_sleep_data),
+    "/hr": ("get_heart_rates", format_heart_rate_data),
+    "/rhr": ("get_rhr_day", None),
+    "/stress": ("get_all_day_stress", None),
+    "/body-composition": ("get_body_composition", None),
+    "/activities/date": ("get_activities_fordate", None),
+    "/training-readiness": ("get_training_readiness", None),
+    "/spo2": ("get_spo2_data", None),
+    "/respiration": ("get_respiration_data", None),
+    "/hydration": ("get_hydration_data", None),
+    "/intensity-minutes": ("get_intensity_minutes_data", None),
+}
+
+
+# Formatters that bring a payload's useful daily numbers up to its top level
+# for the history store. Other payloads are stored as Garmin returns them.
+HISTORY_FORMATTERS: dict[str, Callable[[dict], dict]] = {
+    "get_sleep_data": format_sleep_data,
+    "get_heart_rates": format_heart_rate_data,
+    "get_hrv_data": lambda raw: (format_hrv_data([{"data": raw}]) or [{}])[0],
+}
+
+
+def record_history(method_name: str, day: date, raw: dict):
+    """Store one freshly fetched day in the history store.
+
+    Keeps the payload's top-level numbers as daily fields and its intraday
+    series (SERIES_FIELDS) as samples, under the method name without "get_".
+    A failing write is logged, never passed on to the request.
+    """
+    if not history.enabled:
+        return
+
+    try:
+        formatter = HISTORY_FORMATTERS.get(method_name)
+        payload = formatter(raw) if formatter else raw
+        fields = {
+            name: float(value) for name, value in payload.items()
+            if isinstance(value, (int, float)) and not isinstance(value, bool)
+        }
+        series = {
+            field: valid_samples(raw[field], index)
+            for field, index in SERIES_FIELDS.get(method_name, [])
+            if isinstance(raw.get(field), list)
+        }
+        spans = {}
+        for field in series:
+            times = [sample[0] for sample in raw[field] if sample and isinstance(sample[0], (int, float))]
+            if times:
+                spans[field] = (min(times), max(times))
+        history.record(current_account.get(), method_name.removeprefix("get_"), day, fields, series, spans)
+    except Exception as e:
+        logger.warning(f"Failed to record {method_name} for {day} in history: {e}")
+
+
+def format_options(path: str, query: dict) -> dict:
+    """Keyword arguments for a DAILY_ENDPOINTS formatter, taken from the query."""
+    if path == "/hr":
+        return {
+            "compact": query.get("compact", ["false"])[0] == "true",
+            "include_raw": query.get("raw", ["false"])[0] == "true",
+        }
+    return {}
+
+
+def fetch_daily(api: Garmin, path: str, day: date, query: dict | None = None) -> Any:
+    """Fetch one day of a DAILY_ENDPOINTS endpoint, formatted for the response.
+
+    The query string picks formatter options and any downsampling of the
+    intraday series.
+    """
+    query = query or {}
+    method_name, formatter = DAILY_ENDPOINTS[path]
+    success, result, error = cached_api_call(getattr(api, method_name), day)
+    if not success:
+        return error.to_dict()
+
+    with timed_format(reduce_series):
+        result = reduce_series(method_name, result, query)
+    if formatter is None:
+        return result
+    if not result:
+        return {"error": None}
+    with timed_format(formatter):
+        return formatter(result, **format_options(path, query))
+
+
+def fetch_hrv_day(api: Garmin, day: date) -> dict | None:
+    """Fetch and format one day of HRV, None if nothing was recorded.
+
+    A failed day comes back as {date, error} so range responses can report
+    it in place and the caller can retry just that day.
+    """
+    success, result, error = cached_api_call(api.get_hrv_data, day)
+    if not success:
+        return {"date": day.isoformat(), **error.to_dict()}
+    if not result:
+        return None
+    with timed_format(format_hrv_data):
+        formatted = format_hrv_data([{"date": day.isoformat(), "data": result}])
+    return formatted[0] if formatted else None
+
+
+# Metrics the /bundle endpoint can fetch, named after their single-date path.
+# Each takes the client, the day and the request's query string.
+BUNDLE_METRICS: dict[str, Callable[[Garmin, date, dict], Any]] = {
+    **{
+        path.lstrip("/").replace("/", "-"): (
+            lambda api, day, query, path=path: fetch_daily(api, path, day, query)
+        )
+        for path in DAILY_ENDPOINTS
+    },
+    "hrv": lambda api, day, query: fetch_hrv_day(api, day),
+}
+
+# The Garmin method behind each BUNDLE_METRICS name.
+METRIC_METHODS: dict[str, str] = {
+    **{
+        path.lstrip("/").replace("/", "-"): method_name
+        for path, (method_name, _) in DAILY_ENDPOINTS.items()
+    },
+    "hrv": "get_hrv_data",
+}
+
+
+def sync_status(api: Garmin, metric: str, day: date) -> bool:
+    """Whether a day of a metric is final, fetching it through the cache.
+
+    A failed fetch counts as not final so the day is offered again.
+    """
+    method_name = METRIC_METHODS[metric]
+    success, result, _ = cached_api_call(getattr(api, method_name), day)
+    return success and cache_ttl(method_name, day, result) is None
+
+
+# Per-activity data /activities/export can add to each activity, by name.
+ACTIVITY_PARTS: dict[str, str] = {
+    "details": "get_activity_details",
+    "splits": "get_activity_splits",
+    "hr-zones": "get_activity_hr_in_timezones",
+    "weather": "get_activity_weather",
+    "gear": "get_activity_gear",
+}
+
+
+def activity_pages(api: Garmin, page_size: int) -> Iterator[list[dict]]:
+    """Every page of the activity list, newest first, fetched only as it's needed."""
+    start = 0
+    while True:
+        success, page, error = safe_api_call(api.get_activities, start, page_size)
+        if not success:
+            raise error
+        if not page:
+            return
+        yield page
+        if len(page) < page_size:
+            return
+        start += page_size
+
+
+def fetch_activity(api: Garmin, summary: dict, parts: list[str]) -> dict:
+    """An activity list entry plus the requested ACTIVITY_PARTS, failed parts as errors."""
+    activity = {"id": summary.get("activityId"), "summary": summary}
+    for part in parts:
+        success, result, error = safe_api_call(getattr(api, ACTIVITY_PARTS[part]), activity["id"])
+        activity[part] = result if success else error.to_dict()
+    return activity
+
+
+class BackfillJobs:
+    """Background jobs that fetch every day of a long range, resumable across restarts.
+
+    Jobs and a checkpoint per finished day live in SQLite, so after a
+    restart each unfinished job picks up where it stopped. Days are fetched
+    on a small pool of their own, BACKFILL_CONCURRENCY days at a time across
+    all jobs, leaving the upstream pool to live requests; every call still
+    goes through the shared rate limiter and upstream slots. Fetched days
+    land in the response cache and the history store.
+
+    If the database can't be opened, backfills are disabled: nothing is
+    resumed and the /backfill endpoints answer 503.
+    """
+
+    ACTIVE = ("queued", "running")
+
+    def __init__(self, directory: str, concurrency: int):
+        self.concurrency = concurrency
+        self._pool = ThreadPoolExecutor(concurrency, "backfill")
+        self._lock = threading.Lock()
+        self._cancelled: set[str] = set()
+        # Progress of the jobs running in this process: id -> (start time, days done).
+        self._runs: dict[str, tuple[float, int]] = {}
+        self._db: sqlite3.Connection | None = None
+
+        try:
+            Path(directory).mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(
+                str(Path(directory) / "backfill.sqlite3"),
+                check_same_thread=False,
+                isolation_level=None,
+            )
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    account TEXT NOT NULL,
+                    start TEXT NOT NULL,
+                    end TEXT NOT NULL,
+                    metrics TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+            self._db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS days (
+                    job_id TEXT NOT NULL,
+                    day TEXT NOT NULL,
+                    ok INTEGER NOT NULL,
+                    PRIMARY KEY (job_id, day)
+                ) WITHOUT ROWID
+                """
+            )
+        except (OSError, sqlite3.Error) as e:
+            logger.warning(f"Backfills disabled, could not open {directory}: {e}")
+            self._db = None
+
+    @property
+    def enabled(self) -> bool:
+        return self._db is not None
+
+    def create(self, account: str, start: date, end: date, metrics: list[str]) -> dict:
+        """Queue a job and start it straight away."""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO jobs VALUES (?, ?, ?, ?, ?, 'queued', NULL, ?, ?)",
+                (job_id, account, start.isoformat(), end.isoformat(), ",".join(metrics), now, now),
+            )
+        self._start(job_id)
+        return self.get(account, job_id)
+
+    def get(self, account: str, job_id: str) -> dict | None:
+        if not self._db:
+            return None
+
+        with self._lock:
+            row = self._db.execute(
+                "SELECT * FROM jobs WHERE id = ? AND account = ?", (job_id, account)
+            ).fetchone()
+        return self._status(row) if row else None
+
+    def for_account(self, account: str) -> list[dict]:
+        if not self._db:
+            return []
+
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT * FROM jobs WHERE account = ? ORDER BY created_at DESC", (account,)
+            ).fetchall()
+        return [self._status(row) for row in rows]
+
+    def cancel(self, account: str, job_id: str) -> dict | None:
+        """Stop a job after the days already in flight; None if there's no such job."""
+        job = self.get(account, job_id)
+        if job is None:
+            return None
+        if job["status"] in self.ACTIVE:
+            with self._lock:
+                self._cancelled.add(job_id)
+            self._set_status(job_id, "cancelled")
+        return self.get(account, job_id)
+
+    def cancel_all(self, account: str):
+        """Stop every active job of an account, e.g. before it switches Garmin logins."""
+        for job in self.for_account(account):
+            if job["status"] in self.ACTIVE:
+                self.cancel(account, job["id"])
+
+    def resume(self):
+        """Restart every job a previous process left queued or running."""
+        if not self._db:
+            return
+
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id FROM jobs WHERE status IN ('queued', 'running')"
+            ).fetchall()
+        for (job_id,) in rows:
+            logger.info(f"Resuming backfill {job_id}")
+            self._start(job_id)
+
+    def _start(self, job_id: str):
+        threading.Thread(target=self._run, args=(job_id,), name=f"backfill-{job_id[:8]}", daemon=True).start()
+
+    def _run(self, job_id: str):
+        with self._lock:
+            _, account, start, end, metrics = self._db.execute(
+                "SELECT id, account, start, end, metrics FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+            checkpointed = {
+                day for (day,) in self._db.execute(
+                    "SELECT day FROM days WHERE job_id = ? AND ok = 1", (job_id,)
+                )
+            }
+            self._runs[job_id] = (time.monotonic(), 0)
+
+        current_account.set(account)
+        api = sessions.get(account)
+        if api is None:
+            self._set_status(job_id, "failed", "Not authenticated - call /update-credentials first")
+            return
+
+        metrics = metrics.split(",")
+        days = [
+            day for day in date_range(date.fromisoformat(start), date.fromisoformat(end))
+            if day.isoformat() not in checkpointed
+        ]
+        self._set_status(job_id, "running")
+
+        def fetch_day(day: date) -> tuple[date, bool]:
+            with self._lock:
+                if job_id in self._cancelled:
+                    return day, False
+            # Each day gets its own retry budget, as a request would.
+            retry_budget.set(RetryBudget(config.request_retry_budget))
+            results = [BUNDLE_METRICS[metric](api, day, {}) for metric in metrics]
+            return day, not any(isinstance(r, dict) and r.get("error") for r in results)
+
+        try:
+            for day, ok in fan_out(fetch_day, days, pool=self._pool, window=self.concurrency):
+                with self._lock:
+                    if job_id in self._cancelled:
+                        return
+                self._checkpoint(job_id, day, ok)
+            self._set_status(job_id, "completed")
+        except Exception as e:
+            logger.exception(f"Backfill {job_id} failed")
+            self._set_status(job_id, "failed", str(e))
+
+    def _checkpoint(self, job_id: str, day: date, ok: bool):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO days VALUES (?, ?, ?)", (job_id, day.isoformat(), int(ok))
+            )
+            self._db.execute("UPDATE jobs SET updated_at = ? WHERE id = ?", (time.time(), job_id))
+            started, done = self._runs[job_id]
+            self._runs[job_id] = (started, done + 1)
+
+    def _set_status(self, job_id: str, status: str, error: str | None = None):
+        with self._lock:
+            # A cancelled job stays cancelled whatever its worker says next.
+            self._db.execute(
+                "UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ? AND status != 'cancelled'",
+                (status, error, time.time(), job_id),
+            )
+
+    def _status(self, row: tuple) -> dict:
+        job_id, account, start, end, metrics, status, error, created_at, updated_at = row
+        total = (date.fromisoformat(end) - date.fromisoformat(start)).days + 1
+        with self._lock:
+            counts = dict(self._db.execute(
+                "SELECT ok, COUNT(*) FROM days WHERE job_id = ? GROUP BY ok", (job_id,)
+            ).fetchall())
+            failed_days = [
+                day for (day,) in self._db.execute(
+                    "SELECT day FROM days WHERE job_id = ? AND ok = 0 ORDER BY day LIMIT 100", (job_id,)
+                )
+            ]
+            run = self._runs.get(job_id)
+
+        done = counts.get(1, 0)
+        failed = counts.get(0, 0)
+        # Throughput of this process's run, so a resumed job isn't credited
+        # with days done before the restart.
+        days_per_minute = None
+        eta_seconds = None
+        if run is not None and run[1] and status == "running":
+            elapsed = time.monotonic() - run[0]
+            days_per_minute = round(run[1] / elapsed * 60, 1)
+            eta_seconds = round((total - done - failed) / (run[1] / elapsed))
+
+        return {
+            "id": job_id,
+            "account": account,
+            "start": start,
+            "end": end,
+            "metrics": metrics.split(","),
+            "status": status,
+            "error": error,
+            "days_total": total,
+            "days_done": done,
+            "days_failed": failed,
+            "failed_days": failed_days,
+            "days_per_minute": days_per_minute,
+            "eta_seconds": eta_seconds,
+            "created_at": datetime.fromtimestamp(created_at, timezone.utc).isoformat(),
+            "updated_at": datetime.fromtimestamp(updated_at, timezone.utc).isoformat(),
+        }
+
+
+backfills = BackfillJobs(config.state_dir, config.backfill_concurrency)
+
+
+# Bodies smaller than this aren't worth gzipping.
+GZIP_MIN_BYTES = 1024
+
+
+def content_etag(body: bytes) -> str:
+    """Weak ETag of an uncompressed JSON body, so gzipped and plain copies match."""
+    return f'W/"{hashlib.blake2b(body, digest_size=12).hexdigest()}"'
+
+
+def json_body(data: Any) -> bytes:
+    """A JSON response body, exactly as send_json_response writes it."""
+    return json.dumps(data, default=str, indent=2).encode()
+
+
+class ContentVersions:
+    """When each URL's content last changed, for Last-Modified.
+
+    Keyed by account and request path. An entry's time only moves on when
+    the content's ETag does, so a finalized day keeps the time it was first
+    served however often it's polled. Held in memory, least recently used
+    entries dropped past max_entries; after a restart every URL counts as
+    modified at first sight.
+    """
+
+    def __init__(self, max_entries: int = 10_000):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, tuple[str, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def modified(self, key: str, etag: str) -> float:
+        """The time the content under key became etag."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != etag:
+                entry = (etag, time.time())
+                self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry[1]
+
+
+content_versions = ContentVersions()
+
+
+class CountingWriter:
+    """File-like wrapper that counts the bytes written through it."""
+
+    def __init__(self, raw):
+        self._raw = raw
+        self.written = 0
+
+    def write(self, data: bytes):
+        self.written += len(data)
+        return self._raw.write(data)
+
+    def __getattr__(self, name: str):
+        return getattr(self._raw, name)
+
+
+def render_metrics() -> str:
+    """Every metric in Prometheus text format, plus counters read off the cache,
+    request coalescing, session pool and rate limiter at scrape time."""
+    lines = []
+    for metric in METRICS:
+        lines += [f"# HELP {metric.name} {metric.help}", f"# TYPE {metric.name} {metric.kind}", *metric.samples()]
+
+    cache_stats = cache.stats()
+    flight_stats = single_flight.stats()
+    current = [
+        ("garmin_cache_hits_total", "counter", "Response cache hits.", cache_stats["hits"]),
+        ("garmin_cache_misses_total", "counter", "Response cache misses.", cache_stats["misses"]),
+        ("garmin_cache_evictions_total", "counter", "Response cache LRU evictions.", cache_stats["evictions"]),
+        ("garmin_cache_entries", "gauge", "Responses in the cache.", cache_stats["entries"]),
+        ("garmin_cache_bytes", "gauge", "Size of the cached payloads.", cache_stats["bytes"]),
+        ("garmin_upstream_calls_total", "counter", "Upstream calls made, after coalescing.", flight_stats["calls"]),
+        ("garmin_upstream_collapsed_total", "counter", "Upstream calls joined onto an identical one in flight.",
+         flight_stats["collapsed"]),
+        ("garmin_sessions", "gauge", "Accounts with a live Garmin session.", sessions.stats()["sessions"]),
+        ("garmin_upstream_rate", "gauge", "Current upstream calls per second allowed by the rate limiter.",
+         rate_limiter.rate),
+    ]
+    for name, kind, help, value in current:
+        lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}", f"{name} {value}"]
+    return "\n".join(lines) + "\n"
+
+
+# Paths the service serves, used as the `route` metric label. Anything else
+# is labelled "other" so clients can't create new label values at will.
+METRIC_ROUTES = frozenset({
+    "/health", "/metrics", "/sessions", "/cache/stats", "/upstream/stats", "/update-credentials",
+    "/history", "/history/derived", "/history/series", "/history/daily", "/history/aggregate",
+    "/user/profile", "/user/name", "/sync", "/sync/commit", "/backfill", "/bundle",
+    "/daily-steps", "/hrv", "/body-battery", "/weigh-ins", "/activities", "/activities/export",
+    "/activities/last", "/devices", "/goals", "/badges", "/personal-records",
+    *DAILY_ENDPOINTS,
+})
+
+
+def metric_route(path: str) -> str:
+    """The `route` label for a request path: a known route, with backfill IDs collapsed, or "other"."""
+    if path in METRIC_ROUTES:
+        return path
+    match = re.fullmatch(r"/backfill/[^/]+(/cancel)?", path)
+    if match:
+        return "/backfill/{id}" + (match.group(1) or "")
+    return "other"
+
+
 class GarminHandler(BaseHTTPRequestHandler):
     """HTTP request handler for Garmin API endpoints."""
 
+    # HTTP/1.1 for chunked streaming responses. Connections are still closed
+    # after every response (see end_headers).
+    protocol_version = "HTTP/1.1"
+
+    # Socket timeout - a client that goes quiet mid-request can't pin a worker.
+    timeout = config.request_timeout
+
+    def setup(self):
+        super().setup()
+        self.wfile = CountingWriter(self.wfile)
+
+    def handle_one_request(self):
+        """Handle a request, recording its latency, status and size."""
+        self.started = None
+        self.status = None
+        self.route = "other"
+        token = request_timing.set(RequestTiming())
+        try:
+            super().handle_one_request()
+        finally:
+            request_timing.reset(token)
+            if self.started is not None:
+                requests_in_flight.dec()
+                request_duration.observe(
+                    time.perf_counter() - self.started, self.route, self.command, str(self.status)
+                )
+                response_bytes.inc(self.route, amount=self.wfile.written)
+
+    def parse_request(self) -> bool:
+        # Time from here rather than handle_one_request, which also waits
+        # for the request line to arrive.
+        self.started = time.perf_counter()
+        request_timing.get().started = self.started
+        requests_in_flight.inc()
+        if not super().parse_request():
+            return False
+        self.route = metric_route(urlparse(self.path).path)
+        return True
+
+    def send_response(self, code: int, message: str | None = None):
+        self.status = code
+        super().send_response(code, message)
+
+    def send_not_found(self):
+        self.route = "other"
+        self.send_error_response("Not found", 404)
+
     def log_message(self, format, *args):
         """Override to use our logger."""
         logger.info("%s - %s", self.address_string(), format % args)
 
+    # Keep-alive would pin a pool worker on an idle socket, so by default
+    # every connection carries exactly one request.
+    keep_alive = False
+
+    def end_headers(self):
+        if not self.keep_alive and not self.close_connection:
+            self.send_header("Connection", "close")
+        timing = request_timing.get()
+        if config.timing_headers and timing is not None:
+            self.send_header("Server-Timing", timing.header())
+        super().end_headers()
+
+    def accepts_gzip(self) -> bool:
+        return "gzip" in self.headers.get("Accept-Encoding", "")
+
+    def not_modified(self, etag: str, modified: float) -> bool:
+        """Whether If-None-Match or, failing that, If-Modified-Since matches."""
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None:
+            tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+            return "*" in tags or etag.removeprefix("W/") in tags
+
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if not if_modified_since:
+            return False
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        return int(modified) <= since.timestamp()
+
     def send_json_response(self, data: Any, status: int = 200):
-        """Send a JSON response."""
-        self.send_response(status)
+        """Send a JSON response.
+
+        Successful GETs carry an ETag of the body and the Last-Modified time
+        of that content, and get a bodiless 304 when the client's copy is
+        still current.
+        """
+        body = json_body(data)
+        # Big enough to be gzipped for clients that ask, so caches must key
+        # on Accept-Encoding: the ETag is the same for both encodings.
+        compressible = len(body) >= GZIP_MIN_BYTES
+        if status == 200 and self.command == "GET":
+            etag = content_etag(body)
+            modified = content_versions.modified(f"{current_account.get()}{self.path}", etag)
+            if self.not_modified(etag, modified):
+                status = 304
+            self.send_response(status)
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", self.date_time_string(modified))
+            if compressible:
+                self.send_header("Vary", "Accept-Encoding")
+            if status == 304:
+                self.end_headers()
+                return
+        else:
+            self.send_response(status)
+            if compressible:
+                self.send_header("Vary", "Accept-Encoding")
         self.send_header("Content-Type", "application/json")
+        if compressible and self.accepts_gzip():
+            body = gzip.compress(body, compresslevel=5)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_ndjson_response(self, records: Iterable[Any], status: int = 200):
+        """Stream records as newline-delimited JSON, one compact record per line.
+
+        Each record is written as soon as the iterable produces it, using
+        chunked transfer encoding (and gzip, if the client accepts it), so
+        the full response is never held in memory.
+        """
+        chunked = self.request_version != "HTTP/1.0"
+        compressor = None
+        if not chunked:
+            # Without chunking only closing the connection ends the body.
+            self.close_connection = True
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/x-ndjson")
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        if self.accepts_gzip():
+            compressor = zlib.compressobj(5, zlib.DEFLATED, 31)
+            self.send_header("Content-Encoding", "gzip")
         self.end_headers()
-        self.wfile.write(json.dumps(data, default=str, indent=2).encode())
+
+        def write(data: bytes):
+            if compressor:
+                data = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            if data and chunked:
+                data = f"{len(data):x}\r\n".encode() + data + b"\r\n"
+            self.wfile.write(data)
+
+        try:
+            for record in records:
+                write(json.dumps(record, default=str).encode() + b"\n")
+        except Exception as e:
+            # Headers are long gone, so the failure can only go in the body.
+            logger.exception("Error streaming response")
+            write(json.dumps({"error": str(e)}).encode() + b"\n")
+
+        tail = compressor.flush() if compressor else b""
+        if chunked:
+            if tail:
+                tail = f"{len(tail):x}\r\n".encode() + tail + b"\r\n"
+            tail += b"0\r\n\r\n"
+        self.wfile.write(tail)
+
+    def wants_ndjson(self, query: dict) -> bool:
+        """Whether the client asked for NDJSON via ?format= or Accept."""
+        if "format" in query:
+            return query["format"][0] == "ndjson"
+        return "application/x-ndjson" in self.headers.get("Accept", "")
+
+    def get_days(self, query: dict) -> list[date] | None:
+        """Every day from ?start= to ?end=, or None after sending a 400 for a bad range."""
+        start_date = get_date_param(query, "start", week_start())
+        end_date = get_date_param(query, "end", today())
+        days = date_range(start_date, end_date)
+        if not days:
+            self.send_error_response("start must not be after end", 400)
+            return None
+        if len(days) > config.max_range_days:
+            self.send_error_response(f"Range is limited to {config.max_range_days} days", 400)
+            return None
+        return days
+
+    def send_daily_range(self, api: Garmin, path: str, query: dict):
+        """Fetch every day from ?start= to ?end= and send them keyed by date."""
+        days = self.get_days(query)
+        if days is None:
+            return
+        check_series_options(query)
+
+        payloads = fan_out(lambda day: fetch_daily(api, path, day, query), days)
+        if query.get("versions", ["false"])[0] == "true":
+            self.send_versions(zip(days, payloads))
+        elif self.wants_ndjson(query):
+            self.send_ndjson_response(
+                {"date": day.isoformat(), "data": payload}
+                for day, payload in zip(days, payloads)
+            )
+        else:
+            self.send_json_response({
+                day.isoformat(): payload for day, payload in zip(days, payloads)
+            })
+
+    def send_versions(self, days: Iterable[tuple[date, Any]]):
+        """Send {day: ETag} for a range instead of its data.
+
+        For endpoints with a single-date form each day's tag is the ETag
+        that day's response carries, so a client can compare the tags with
+        the ones it holds and refetch only the days that changed.
+        """
+        self.send_json_response({day.isoformat(): content_etag(json_body(payload)) for day, payload in days})
+
+    def send_bundle(self, api: Garmin, query: dict):
+        """Fetch several metrics for every day in a range in one request.
+
+        Every (day, metric) pair goes to the upstream pool at once, so wall
+        time grows with the number of days rather than days x metrics.
+        """
+        metrics = query.get("metrics", ["sleep,hr,hrv"])[0].split(",")
+        unknown = [m for m in metrics if m not in BUNDLE_METRICS]
+        if unknown:
+            self.send_error_response(f"Unknown metrics: {', '.join(unknown)}", 400)
+            return
+
+        days = self.get_days(query)
+        if days is None:
+            return
+        check_series_options(query)
+
+        pairs = [(day, metric) for day in days for metric in metrics]
+        results = fan_out(lambda pair: BUNDLE_METRICS[pair[1]](api, pair[0], query), pairs)
+        bundles = ((day, {metric: next(results) for metric in metrics}) for day in days)
+
+        if query.get("versions", ["false"])[0] == "true":
+            self.send_versions(bundles)
+        elif self.wants_ndjson(query):
+            self.send_ndjson_response(
+                {"date": day.isoformat(), "data": bundle} for day, bundle in bundles
+            )
+        else:
+            self.send_json_response({day.isoformat(): bundle for day, bundle in bundles})
+
+    def send_sync(self, api: Garmin, account: str, query: dict):
+        """List the days in a range with metrics the client hasn't synced in final form.
+
+        Each pending (day, metric) is fetched, through the cache, to see
+        whether Garmin has finished with it; the client then fetches those
+        days (cache hits by now) and commits the returned cursor.
+        """
+        if not sync_cursor.enabled:
+            self.send_error_response("Sync state unavailable", 503)
+            return
+        metrics = query.get("metrics", ["sleep,hr,hrv"])[0].split(",")
+        unknown = [m for m in metrics if m not in METRIC_METHODS]
+        if unknown:
+            self.send_error_response(f"Unknown metrics: {', '.join(unknown)}", 400)
+            return
+        days = self.get_days(query)
+        if days is None:
+            return
+
+        synced = sync_cursor.synced(account, days[0], days[-1])
+        pairs = [
+            (day, metric) for day in days for metric in metrics
+            if not synced.get((day.isoformat(), metric))
+        ]
+        finals = fan_out(lambda pair: sync_status(api, pair[1], pair[0]), pairs)
+        entries = [(day.isoformat(), metric, final) for (day, metric), final in zip(pairs, finals)]
+
+        pending: dict[str, dict[str, str]] = {}
+        for day, metric, _ in entries:
+            # "provisional" if the client already has a version Garmin has
+            # since revised (or may still), "new" if it has nothing.
+            pending.setdefault(day, {})[metric] = "provisional" if (day, metric) in synced else "new"
+
+        self.send_json_response({
+            "cursor": sync_cursor.stage(account, entries) if entries else None,
+            "days": pending,
+        })
+
+    def send_history(self, account: str, path: str, query: dict):
+        """Answer /history queries from the local history store, no upstream calls."""
+        if path == "/history":
+            self.send_json_response(history.stats(account))
+            return
+
+        start_date = get_date_param(query, "start", week_start())
+        end_date = get_date_param(query, "end", today())
+        if start_date > end_date:
+            self.send_error_response("start must not be after end", 400)
+            return
+
+        if path == "/history/derived":
+            fields = query.get("fields", [""])[0]
+            self.send_json_response(
+                history.derived(account, start_date, end_date, fields.split(",") if fields else None)
+            )
+            return
+
+        if path == "/history/series":
+            name = query.get("series", [""])[0]
+            if not name:
+                self.send_error_response("series required", 400)
+                return
+            resolution = query.get("resolution", [None])[0]
+            step = parse_resolution(resolution) if resolution else None
+            if resolution == "day":
+                step = 86_400_000
+            start_ms = int(datetime(start_date.year, start_date.month, start_date.day, tzinfo=timezone.utc).timestamp() * 1000)
+            end_ms = start_ms + ((end_date - start_date).days + 1) * 86_400_000
+            self.send_json_response(history.series(account, name, start_ms, end_ms, step))
+            return
+
+        metric = query.get("metric", [""])[0]
+        if not metric:
+            self.send_error_response("metric required", 400)
+            return
+
+        if path == "/history/daily":
+            fields = query.get("fields", [""])[0]
+            self.send_json_response(
+                history.daily(account, metric, start_date, end_date, fields.split(",") if fields else None)
+            )
+        elif path == "/history/aggregate":
+            field = query.get("field", [""])[0]
+            period = query.get("period", ["all"])[0]
+            if not field:
+                self.send_error_response("field required", 400)
+                return
+            if period not in HistoryStore.PERIODS:
+                self.send_error_response(f"period must be one of {', '.join(HistoryStore.PERIODS)}", 400)
+                return
+            self.send_json_response(history.aggregate(account, metric, field, start_date, end_date, period))
+        else:
+            self.send_not_found()
+
+    def send_activity_export(self, api: Garmin, account: str, query: dict):
+        """Stream every activity with its details as NDJSON, one activity per line.
+
+        The activity list is paged through lazily and each page's activities
+        go to the upstream pool, so only a small window of activities is ever
+        in memory. Activities already exported to the account are skipped
+        unless ?all=true; an activity counts as exported once its line has
+        been written with every part fetched. Without the sync state there's
+        no telling what was exported, so only ?all=true is served then.
+        """
+        parts = [p for p in query.get("include", ["details,splits"])[0].split(",") if p]
+        unknown = [p for p in parts if p not in ACTIVITY_PARTS]
+        if unknown:
+            self.send_error_response(f"Unknown parts: {', '.join(unknown)}", 400)
+            return
+        page_size = min(int(query.get("page_size", [100])[0]), 1000)
+        limit = int(query.get("limit", [0])[0])
+        include_exported = query.get("all", ["false"])[0].lower() == "true"
+        if page_size <= 0 or limit < 0:
+            raise ValueError("page_size must be positive and limit not negative")
+        if not include_exported and not sync_cursor.enabled:
+            self.send_error_response("Sync state unavailable, use all=true", 503)
+            return
+
+        def summaries() -> Iterator[dict]:
+            for page in activity_pages(api, page_size):
+                skip = set() if include_exported else sync_cursor.exported(
+                    account, [a.get("activityId") for a in page if a.get("activityId") is not None]
+                )
+                yield from (a for a in page if a.get("activityId") not in skip)
+
+        pending = summaries()
+        if limit:
+            pending = itertools.islice(pending, limit)
+
+        def records() -> Iterator[dict]:
+            for activity in fan_out(lambda summary: fetch_activity(api, summary, parts), pending):
+                yield activity
+                # Getting here means the line above made it onto the wire.
+                complete = not any(isinstance(activity[p], dict) and activity[p].get("error") for p in parts)
+                if complete and activity["id"] is not None:
+                    sync_cursor.mark_exported(account, activity["id"])
+
+        self.send_ndjson_response(records())
 
     def send_error_response(self, message: str, status: int = 500):
         """Send an error response."""
         self.send_json_response({"error": message}, status)
 
+    def get_account(self, query: dict) -> str | None:
+        """The account a request is for, from X-Garmin-Account or ?account=.
+
+        Returns None for an account name that isn't safe to use as a
+        directory name.
+        """
+        account = self.headers.get("X-Garmin-Account") or query.get("account", [DEFAULT_ACCOUNT])[0]
+        return account if ACCOUNT_PATTERN.match(account) else None
+
+    def get_timezone(self, query: dict) -> ZoneInfo | None:
+        """The timezone a request's date defaults are in, from X-Timezone or ?tz=.
+
+        Returns None for a name that isn't an IANA timezone.
+        """
+        name = self.headers.get("X-Timezone") or query.get("tz", [None])[0]
+        if not name:
+            return ZoneInfo(config.default_timezone)
+        try:
+            return ZoneInfo(name)
+        except (ZoneInfoNotFoundError, ValueError):
+            return None
+
     def check_auth(self) -> bool:
         """Check API key authentication."""
         parsed = urlparse(self.path)
@@ -251,214 +2889,154 @@ class GarminHandler(BaseHTTPRequestHandler):
         parsed = urlparse(self.path)
         path = parsed.path
         query = parse_qs(parsed.query)
+        retry_budget.set(RetryBudget(config.request_retry_budget))
+
+        account = self.get_account(query)
+        if account is None:
+            self.send_error_response("Invalid account", 400)
+            return
+        current_account.set(account)
+
+        tz = self.get_timezone(query)
+        if tz is None:
+            self.send_error_response("Invalid timezone", 400)
+            return
+        request_timezone.set(tz)
 
         try:
             if path == "/health":
+                # Answer straight away, even mid-login, so probes never block
+                # on Garmin.
                 self.send_json_response({
                     "status": "healthy",
-                    "authenticated": api is not None
+                    "account": account,
+                    **sessions.status(account),
+                    "sessions": sessions.stats()["sessions"],
                 })
                 return
 
+            if path == "/metrics":
+                body = render_metrics().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+
+            if path == "/sessions":
+                self.send_json_response(sessions.stats())
+                return
+
+            if path == "/cache/stats":
+                self.send_json_response(cache.stats())
+                return
+
+            if path == "/upstream/stats":
+                self.send_json_response(single_flight.stats())
+                return
+
+            if path == "/history" or path.startswith("/history/"):
+                # Served locally, so no need to log the account in.
+                self.send_history(account, path, query)
+                return
+
+            # Take the client once so a concurrent /update-credentials can't
+            # swap it out halfway through a request.
+            api = sessions.get(account)
+
             if not api:
                 self.send_error_response("Not authenticated - call /update-credentials first", 401)
                 return
 
             if path == "/user/profile":
                 success, result, error = safe_api_call(api.get_user_profile)
-                self.send_json_response(result if success else {"error": error})
+                self.send_json_response(result if success else error.to_dict())
 
             elif path == "/user/name":
                 success, result, error = safe_api_call(api.get_full_name)
-                self.send_json_response({"name": result} if success else {"error": error})
+                self.send_json_response({"name": result} if success else error.to_dict())
 
-            elif path == "/user/summary":
-                target_date = get_date_param(query, "date", config.today)
-                success, result, error = safe_api_call(
-                    api.get_user_summary, target_date.isoformat()
-                )
-                self.send_json_response(result if success else {"error": error})
+            elif path in DAILY_ENDPOINTS:
+                if "start" in query or "end" in query:
+                    self.send_daily_range(api, path, query)
+                else:
+                    target_date = get_date_param(query, "date", today())
+                    self.send_json_response(
+                        fetch_daily(api, path, target_date, query)
+                    )
 
-            elif path == "/stats":
-                target_date = get_date_param(query, "date", config.today)
-                success, result, error = safe_api_call(
-                    api.get_stats, target_date.isoformat()
-                )
-                self.send_json_response(result if success else {"error": error})
+            elif path == "/sync":
+                self.send_sync(api, account, query)
 
-            elif path == "/stats/body":
-                target_date = get_date_param(query, "date", config.today)
-                success, result, error = safe_api_call(
-                    api.get_stats_and_body, target_date.isoformat()
-                )
-                self.send_json_response(result if success else {"error": error})
+            elif (path == "/backfill" or path.startswith("/backfill/")) and not backfills.enabled:
+                self.send_error_response("Backfill state unavailable", 503)
 
-            elif path == "/heart-rate":
-                target_date = get_date_param(query, "date", config.today)
-                success, result, error = safe_api_call(
-                    api.get_heart_rates, target_date.isoformat()
-                )
-                self.send_json_response(result if success else {"error": error})
+            elif path == "/backfill":
+                self.send_json_response(backfills.for_account(account))
 
-            elif path == "/resting-heart-rate":
-                target_date = get_date_param(query, "date", config.today)
-                success, result, error = safe_api_call(
-                    api.get_resting_heart_rate, target_date.isoformat()
-                )
-                self.send_json_response(result if success else {"error": error})
+            elif path.startswith("/backfill/"):
+                job = backfills.get(account, path.removeprefix("/backfill/"))
+                if job is None:
+                    self.send_error_response("Backfill not found", 404)
+                else:
+                    self.send_json_response(job)
 
-            elif path == "/steps":
-                target_date = get_date_param(query, "date", config.today)
-                success, result, error = safe_api_call(
-                    api.get_steps_data, target_date.isoformat()
-                )
-                self.send_json_response(result if success else {"error": error})
+            elif path == "/bundle":
+                self.send_bundle(api, query)
 
             elif path == "/daily-steps":
-                start_date = get_date_param(query, "start", config.week_start)
-                end_date = get_date_param(query, "end", config.today)
-                success, result, error = safe_api_call(
-                    api.get_daily_steps, start_date.isoformat(), end_date.isoformat()
+                start_date = get_date_param(query, "start", week_start())
+                end_date = get_date_param(query, "end", today())
+                success, result, error = cached_api_call(
+                    api.get_daily_steps, start_date, end_date
                 )
-                self.send_json_response(result if success else {"error": error})
-
-            elif path == "/sleep":
-                target_date = get_date_param(query, "date", config.today)
-                success, result, error = safe_api_call(
-                    api.get_sleep_data, target_date.isoformat()
-                )
-                if success and result:
-                    sleep_payload = format_sleep_data(result)
-                    self.send_json_response(sleep_payload)
-                else:
-                    self.send_json_response({"error": error})
-
-            elif path == "/hr":
-                target_date = get_date_param(query, "date", config.today)
-                success, result, error = safe_api_call(
-                    api.get_heart_rates, target_date.isoformat()
-                )
-                if success and result:
-                    hr_payload = format_heart_rate_data(result)
-                    self.send_json_response(hr_payload)
-                else:
-                    self.send_json_response({"error": error})
+                self.send_json_response(result if success else error.to_dict())
 
             elif path == "/hrv":
-                start_date = get_date_param(query, "start", config.week_start)
-                end_date = get_date_param(query, "end", config.today)
-                hrv_data = []
-                current = start_date
-                while current <= end_date:
-                    success, result, error = safe_api_call(
-                        api.get_hrv_data, current.isoformat()
-                    )
-                    if success and result:
-                        hrv_data.append({
-                            "date": current.isoformat(),
-                            "data": result
-                        })
-                    current += timedelta(days=1)
-                self.send_json_response(format_hrv_data(hrv_data))
-
-            elif path == "/rhr":
-                target_date = get_date_param(query, "date", config.today)
-                success, result, error = safe_api_call(
-                    api.get_rhr_day, target_date.isoformat()
-                )
-                self.send_json_response(result if success else {"error": error})
-
-            elif path == "/stress":
-                target_date = get_date_param(query, "date", config.today)
-                success, result, error = safe_api_call(
-                    api.get_all_day_stress, target_date.isoformat()
-                )
-                self.send_json_response(result if success else {"error": error})
+                days = self.get_days(query)
+                if days is None:
+                    return
+                results = fan_out(lambda day: fetch_hrv_day(api, day), days)
+                if query.get("versions", ["false"])[0] == "true":
+                    # Days without HRV are listed too, as the tag of null.
+                    self.send_versions(zip(days, results))
+                else:
+                    self.send_json_response([r for r in results if r is not None])
 
             elif path == "/body-battery":
-                start_date = get_date_param(query, "start", config.week_start)
-                end_date = get_date_param(query, "end", config.today)
-                success, result, error = safe_api_call(
-                    api.get_body_battery, start_date.isoformat(), end_date.isoformat()
+                start_date = get_date_param(query, "start", week_start())
+                end_date = get_date_param(query, "end", today())
+                success, result, error = cached_api_call(
+                    api.get_body_battery, start_date, end_date
                 )
-                self.send_json_response(result if success else {"error": error})
-
-            elif path == "/body-composition":
-                target_date = get_date_param(query, "date", config.today)
-                success, result, error = safe_api_call(
-                    api.get_body_composition, target_date.isoformat()
-                )
-                self.send_json_response(result if success else {"error": error})
+                if success:
+                    result = reduce_series("get_body_battery", result, query)
+                self.send_json_response(result if success else error.to_dict())
 
             elif path == "/weigh-ins":
-                start_date = get_date_param(query, "start", config.week_start)
-                end_date = get_date_param(query, "end", config.today)
-                success, result, error = safe_api_call(
-                    api.get_weigh_ins, start_date.isoformat(), end_date.isoformat()
+                start_date = get_date_param(query, "start", week_start())
+                end_date = get_date_param(query, "end", today())
+                success, result, error = cached_api_call(
+                    api.get_weigh_ins, start_date, end_date
                 )
-                self.send_json_response(result if success else {"error": error})
+                self.send_json_response(result if success else error.to_dict())
 
             elif path == "/activities":
                 limit = int(query.get("limit", [10])[0])
                 success, result, error = safe_api_call(api.get_activities, 0, limit)
-                self.send_json_response(result if success else {"error": error})
+                self.send_json_response(result if success else error.to_dict())
+
+            elif path == "/activities/export":
+                self.send_activity_export(api, account, query)
 
             elif path == "/activities/last":
                 success, result, error = safe_api_call(api.get_last_activity)
-                self.send_json_response(result if success else {"error": error})
-
-            elif path == "/activities/date":
-                target_date = get_date_param(query, "date", config.today)
-                success, result, error = safe_api_call(
-                    api.get_activities_fordate, target_date.isoformat()
-                )
-                self.send_json_response(result if success else {"error": error})
+                self.send_json_response(result if success else error.to_dict())
 
             elif path == "/devices":
                 success, result, error = safe_api_call(api.get_devices)
-                self.send_json_response(result if success else {"error": error})
-
-            elif path == "/training-readiness":
-                target_date = get_date_param(query, "date", config.today)
-                success, result, error = safe_api_call(
-                    api.get_training_readiness, target_date.isoformat()
-                )
-                self.send_json_response(result if success else {"error": error})
-
-            elif path == "/hrv":
-                target_date = get_date_param(query, "date", config.today)
-                success, result, error = safe_api_call(
-                    api.get_hrv_data, target_date.isoformat()
-                )
-                self.send_json_response(result if success else {"error": error})
-
-            elif path == "/spo2":
-                target_date = get_date_param(query, "date", config.today)
-                success, result, error = safe_api_call(
-                    api.get_spo2_data, target_date.isoformat()
-                )
-                self.send_json_response(result if success else {"error": error})
-
-            elif path == "/respiration":
-                target_date = get_date_param(query, "date", config.today)
-                success, result, error = safe_api_call(
-                    api.get_respiration_data, target_date.isoformat()
-                )
-                self.send_json_response(result if success else {"error": error})
-
-            elif path == "/hydration":
-                target_date = get_date_param(query, "date", config.today)
-                success, result, error = safe_api_call(
-                    api.get_hydration_data, target_date.isoformat()
-                )
-                self.send_json_response(result if success else {"error": error})
-
-            elif path == "/intensity-minutes":
-                target_date = get_date_param(query, "date", config.today)
-                success, result, error = safe_api_call(
-                    api.get_intensity_minutes_data, target_date.isoformat()
-                )
-                self.send_json_response(result if success else {"error": error})
+                self.send_json_response(result if success else error.to_dict())
 
             elif path == "/goals":
                 goal_type = query.get("type", ["active"])[0]
@@ -471,19 +3049,22 @@ class GarminHandler(BaseHTTPRequestHandler):
                 else:
                     self.send_error_response("Invalid goal type", 400)
                     return
-                self.send_json_response(result if success else {"error": error})
+                self.send_json_response(result if success else error.to_dict())
 
             elif path == "/badges":
                 success, result, error = safe_api_call(api.get_earned_badges)
-                self.send_json_response(result if success else {"error": error})
+                self.send_json_response(result if success else error.to_dict())
 
             elif path == "/personal-records":
                 success, result, error = safe_api_call(api.get_personal_records)
-                self.send_json_response(result if success else {"error": error})
+                self.send_json_response(result if success else error.to_dict())
 
             else:
-                self.send_error_response("Not found", 404)
+                self.send_not_found()
 
+        except ValueError as e:
+            # Malformed query parameters, e.g. a date that isn't YYYY-MM-DD.
+            self.send_error_response(str(e), 400)
         except Exception as e:
             logger.exception("Error handling request")
             self.send_error_response(str(e))
@@ -510,52 +3091,417 @@ class GarminHandler(BaseHTTPRequestHandler):
                     self.send_error_response("Email and password required", 400)
                     return
 
-                logger.info(f"Updating credentials for {email}")
+                account = self.get_account(parse_qs(parsed.query))
+                if "account" in data:
+                    account = data["account"] if ACCOUNT_PATTERN.match(str(data["account"])) else None
+                if account is None:
+                    self.send_error_response("Invalid account", 400)
+                    return
+
+                logger.info(f"Updating credentials for {email} (account {account})")
+
+                # Check the client can store tokens before dropping the old ones.
+                garmin = Garmin(email, password)
+                garth_client(garmin)
+
+                # Backfills hold the old client; stop them before they write
+                # more of its data after the clear below.
+                backfills.cancel_all(account)
 
                 # Clear existing tokens to force re-login
-                tokenstore = Path(config.tokenstore)
-                for f in ["oauth1_token.json", "oauth2_token.json"]:
+                tokenstore = sessions.tokenstore(account)
+                for f in TOKEN_FILES:
                     token_file = tokenstore / f
                     if token_file.exists():
                         token_file.unlink()
 
                 # Login with new credentials
-                garmin = Garmin(email, password)
                 token1, token2 = garmin.login("")
-                garth.save(str(tokenstore))
+                save_tokens(garmin, tokenstore)
 
-                global api
-                api = garmin
+                # Cached responses, sync state and history may belong to the
+                # previous login.
+                cache.clear(account)
+                sync_cursor.reset(account)
+                history.clear(account)
+                sessions.set(account, garmin)
 
                 self.send_json_response({"status": "success", "message": "Credentials updated and tokens stored"})
 
             except Exception as e:
                 logger.exception("Failed to update credentials")
                 self.send_error_response(f"Failed to update credentials: {str(e)}")
+
+        elif path == "/backfill" or (path.startswith("/backfill/") and path.endswith("/cancel")):
+            account = self.get_account(parse_qs(parsed.query))
+            if account is None:
+                self.send_error_response("Invalid account", 400)
+                return
+
+            tz = self.get_timezone(parse_qs(parsed.query))
+            if tz is None:
+                self.send_error_response("Invalid timezone", 400)
+                return
+            request_timezone.set(tz)
+
+            if not backfills.enabled:
+                self.send_error_response("Backfill state unavailable", 503)
+                return
+
+            if path != "/backfill":
+                job = backfills.cancel(account, path.removeprefix("/backfill/").removesuffix("/cancel"))
+                if job is None:
+                    self.send_error_response("Backfill not found", 404)
+                else:
+                    self.send_json_response(job)
+                return
+
+            try:
+                content_length = int(self.headers.get('Content-Length', 0))
+                data = json.loads(self.rfile.read(content_length).decode())
+                if not isinstance(data, dict) or not data.get("start"):
+                    self.send_error_response("start required", 400)
+                    return
+
+                query = {k: [str(data[k])] for k in ("start", "end") if data.get(k)}
+                start_date = get_date_param(query, "start", today())
+                end_date = get_date_param(query, "end", today())
+                if start_date > end_date:
+                    self.send_error_response("start must not be after end", 400)
+                    return
+
+                metrics = data.get("metrics") or ["sleep", "hr", "hrv"]
+                if isinstance(metrics, str):
+                    metrics = metrics.split(",")
+                unknown = [m for m in metrics if m not in BUNDLE_METRICS]
+                if unknown:
+                    self.send_error_response(f"Unknown metrics: {', '.join(map(str, unknown))}", 400)
+                    return
+
+                if sessions.get(account) is None:
+                    self.send_error_response("Not authenticated - call /update-credentials first", 401)
+                    return
+
+                self.send_json_response(backfills.create(account, start_date, end_date, metrics), 202)
+
+            except ValueError as e:
+                # Malformed JSON or a date that isn't YYYY-MM-DD.
+                self.send_error_response(str(e), 400)
+            except Exception as e:
+                logger.exception("Failed to start backfill")
+                self.send_error_response(f"Failed to start backfill: {str(e)}")
+
+        elif path == "/sync/commit":
+            account = self.get_account(parse_qs(parsed.query))
+            if account is None:
+                self.send_error_response("Invalid account", 400)
+                return
+            if not sync_cursor.enabled:
+                self.send_error_response("Sync state unavailable", 503)
+                return
+
+            try:
+                content_length = int(self.headers.get('Content-Length', 0))
+                data = json.loads(self.rfile.read(content_length).decode())
+                cursor = data.get("cursor") if isinstance(data, dict) else None
+                if not isinstance(cursor, str):
+                    self.send_error_response("cursor required", 400)
+                    return
+
+                committed = sync_cursor.commit(account, cursor)
+                if committed is None:
+                    self.send_error_response("Unknown or expired cursor", 404)
+                    return
+                self.send_json_response({"status": "success", "committed": committed})
+
+            except ValueError:
+                self.send_error_response("Invalid JSON body", 400)
+            except Exception as e:
+                logger.exception("Failed to commit sync cursor")
+                self.send_error_response(f"Failed to commit sync cursor: {str(e)}")
         else:
-            self.send_error_response("Not found", 404)
+            self.send_not_found()
+
+
+class PooledHTTPServer(HTTPServer):
+    """HTTP server that hands connections to a fixed pool of worker threads.
+
+    Accepted connections wait in a bounded queue for a free worker. Once the
+    queue is full, new connections are answered with 503 straight away rather
+    than piling up, and connections that waited longer than the request
+    timeout are dropped the same way since their client has likely given up.
+    """
+
+    def __init__(self, server_address, handler_class, workers: int, queue_size: int, timeout: float):
+        super().__init__(server_address, handler_class)
+        self.request_timeout = timeout
+        self.pending: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.worker_threads = [
+            threading.Thread(target=self._worker, name=f"worker-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self.worker_threads:
+            thread.start()
+
+    def process_request(self, request, client_address):
+        try:
+            self.pending.put_nowait((request, client_address, time.monotonic()))
+        except queue.Full:
+            logger.warning(f"Request queue full, rejecting {client_address[0]}")
+            self.reject_request(request)
+
+    def reject_request(self, request):
+        """Answer with 503 without involving a worker, then close."""
+        body = json.dumps({"error": "Server busy, try again shortly"}).encode()
+        head = (
+            "HTTP/1.0 503 Service Unavailable\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Retry-After: 1\r\n"
+            "Connection: close\r\n\r\n"
+        ).encode()
+        try:
+            request.sendall(head + body)
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def _worker(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
 
+            request, client_address, queued_at = item
+            if time.monotonic() - queued_at > self.request_timeout:
+                logger.warning(f"Request from {client_address[0]} timed out in queue")
+                self.reject_request(request)
+                continue
 
-def main():
-    """Main entry point."""
-    global api
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        for _ in self.worker_threads:
+            self.pending.put(None)
+
+
+class LoopConnection:
+    """Socket stand-in that lets a GarminHandler run on a worker thread for AsyncHTTPServer.
+
+    The handler reads the request, already received by the event loop, from
+    memory. Its writes are handed to the connection's asyncio stream and
+    wait for it to drain, so a streamed response still has backpressure. A
+    client that stops reading for longer than the handler's timeout gets
+    its connection aborted, as a blocking socket would time out, so it
+    can't hold a worker for good.
+    """
+
+    def __init__(self, request: bytes, writer: asyncio.StreamWriter, loop: asyncio.AbstractEventLoop):
+        self._request = request
+        self._writer = writer
+        self._loop = loop
+        self._timeout: float | None = None
+
+    def settimeout(self, timeout: float | None):
+        self._timeout = timeout
+
+    def makefile(self, mode: str, buffering: int = -1):
+        return io.BytesIO(self._request)
+
+    def sendall(self, data: bytes):
+        asyncio.run_coroutine_threadsafe(self._send(bytes(data)), self._loop).result()
+
+    async def _send(self, data: bytes):
+        self._writer.write(data)
+        try:
+            await asyncio.wait_for(self._writer.drain(), self._timeout)
+        except asyncio.TimeoutError:
+            self._writer.transport.abort()
+            raise TimeoutError("Client stopped reading the response")
 
-    logger.info("Starting Garmin Connect Service")
 
+class AsyncRequestHandler(GarminHandler):
+    """GarminHandler for a single request received by AsyncHTTPServer.
+
+    Idle keep-alive connections only cost the event loop a coroutine, so
+    unlike the thread pool modes connections stay open between requests.
+    """
+
+    keep_alive = True
+
+    def handle(self):
+        self.handle_one_request()
+
+
+class AsyncHTTPServer:
+    """SERVER_MODE=async: connections are served from an asyncio event loop.
+
+    The loop accepts connections, reads requests (and waits on idle
+    keep-alive connections) without tying up a thread, so hundreds of
+    clients cost a few KB each. Each complete request is then handled by
+    GarminHandler on a bounded executor of WORKERS threads, whose upstream
+    calls fan out on the upstream pool as usual. Requests wait on the loop
+    for a free worker, up to REQUEST_TIMEOUT, instead of being turned away
+    by a fixed queue.
+
+    Only idle connections get cheaper: a request holds its worker thread
+    until the response is written, upstream waits included, so requests
+    in progress are still capped at WORKERS just as in threaded mode.
+    """
+
+    # Largest request head read before the connection is dropped.
+    MAX_HEAD_BYTES = 1 << 20
+
+    def __init__(self, server_address: tuple[str, int], workers: int, timeout: float):
+        self.server_address = server_address
+        self.request_timeout = timeout
+        self.socket = socket.create_server(server_address)
+        self._handlers = ThreadPoolExecutor(workers, "worker")
+        self._slots = asyncio.Semaphore(workers)
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._stopped: asyncio.Event | None = None
+
+    def serve_forever(self):
+        asyncio.run(self._serve())
+
+    def shutdown(self):
+        if self._loop is not None and self._stopped is not None:
+            self._loop.call_soon_threadsafe(self._stopped.set)
+
+    def server_close(self):
+        self._handlers.shutdown(wait=False)
+        self.socket.close()
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        server = await asyncio.start_server(self._connection, sock=self.socket, limit=self.MAX_HEAD_BYTES)
+        async with server:
+            await self._stopped.wait()
+
+    async def _connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        client_address = writer.get_extra_info("peername") or ("", 0)
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.request_timeout)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, asyncio.LimitOverrunError):
+                    return
+                body = b""
+                match = re.search(rb"\r\ncontent-length:\s*(\d+)", head, re.IGNORECASE)
+                if match:
+                    body = await asyncio.wait_for(reader.readexactly(int(match.group(1))), self.request_timeout)
+
+                try:
+                    await asyncio.wait_for(self._slots.acquire(), self.request_timeout)
+                except asyncio.TimeoutError:
+                    logger.warning(f"Request from {client_address[0]} timed out waiting for a worker")
+                    await self._reject(writer)
+                    return
+                try:
+                    keep_alive = await self._loop.run_in_executor(
+                        self._handlers, self._handle, head + body, client_address, writer
+                    )
+                finally:
+                    self._slots.release()
+                if not keep_alive:
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
+        except asyncio.CancelledError:
+            # Server shutting down with the connection still open.
+            pass
+        finally:
+            writer.close()
+
+    def _handle(self, request: bytes, client_address, writer: asyncio.StreamWriter) -> bool:
+        """Run one request through the handler; whether the connection may stay open."""
+        try:
+            handler = AsyncRequestHandler(LoopConnection(request, writer, self._loop), client_address, self)
+        except OSError as e:
+            logger.warning(f"Dropped connection from {client_address[0]}: {e!r}")
+            return False
+        except Exception:
+            logger.exception(f"Error handling request from {client_address[0]}")
+            return False
+        return not handler.close_connection
+
+    async def _reject(self, writer: asyncio.StreamWriter):
+        body = json.dumps({"error": "Server busy, try again shortly"}).encode()
+        writer.write(
+            (
+                "HTTP/1.1 503 Service Unavailable\r\n"
+                "Content-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Retry-After: 1\r\n"
+                "Connection: close\r\n\r\n"
+            ).encode() + body
+        )
+        await writer.drain()
+
+
+def create_server() -> HTTPServer | AsyncHTTPServer:
+    """Build the HTTP server for the configured SERVER_MODE."""
+    address = ("", config.port)
+    if config.server_mode == "single":
+        return HTTPServer(address, GarminHandler)
+    if config.server_mode == "threaded":
+        return PooledHTTPServer(
+            address,
+            GarminHandler,
+            workers=config.workers,
+            queue_size=config.queue_size,
+            timeout=config.request_timeout,
+        )
+    if config.server_mode == "async":
+        return AsyncHTTPServer(address, workers=config.workers, timeout=config.request_timeout)
+    raise ValueError(f"Unknown SERVER_MODE: {config.server_mode}")
+
+
+def startup_login():
+    """Log the default account in from its tokens or GARMIN_EMAIL/GARMIN_PASSWORD."""
     try:
-        api = init_api()
+        sessions.login(DEFAULT_ACCOUNT, init_api)
     except Exception as e:
         logger.warning(f"Failed to initialize API: {e}")
-        logger.info("Service starting without API - use /update-credentials to authenticate")
+        logger.info("Service running without API - use /update-credentials to authenticate")
+
+
+def refresh_tokens():
+    """Keep live sessions' OAuth2 tokens from expiring, forever."""
+    while True:
+        time.sleep(config.token_refresh_interval)
+        try:
+            sessions.refresh_expiring(config.token_refresh_margin)
+        except Exception as e:
+            logger.warning(f"Token refresh check failed: {e}")
+
+
+def main():
+    """Main entry point."""
+    logger.info("Starting Garmin Connect Service")
+
+    server = create_server()
+    logger.info(f"Server running on port {config.port} ({config.server_mode} mode)")
 
-    server = HTTPServer(("", config.port), GarminHandler)
-    logger.info(f"Server running on port {config.port}")
+    # Log in after we're listening so a slow or failing Garmin login doesn't
+    # hold up readiness; /health reports how it's going.
+    threading.Thread(target=startup_login, name="startup-login", daemon=True).start()
+    threading.Thread(target=refresh_tokens, name="token-refresh", daemon=True).start()
+    backfills.resume()
 
     try:
         server.serve_forever()
     except KeyboardInterrupt:
         logger.info("Shutting down")
         server.shutdown()
+        server.server_close()
 
 
 if __name__ == "__main__":